@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""Benchmark the import pipeline offline on generated Slack exports
+
+For each size, an export is generated with that many messages (spread over
+a number of channels, with threads, reactions, long messages and files)
+and then:
+ - parsed channel by channel (as the parse workers do) to get the parsing
+   speed
+ - compiled (see `slack-to-discord compile`) and parsed again from that
+ - imported into a DryRunGuild (files are served locally) to get the speed
+   of the whole pipeline and the Discord API calls it would make
+
+Usage: python benchmarks/benchmark.py [--sizes 10000 100000 1000000]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import slack_to_discord  # noqa: E402
+import slack_to_discord_client  # noqa: E402
+
+
+MESSAGES_PER_DAY = 200
+TEXTS = [
+    "ok",
+    "sounds good to me :+1:",
+    "see <@U3> about that, it's in <#C1|general>",
+    "has anyone looked at <https://example.com/builds/1234|the build> yet?",
+    "lunch? :pizza::pizza:",
+    "a much longer message " * 120,
+]
+FILE_SIZE = 32 * 1024
+
+
+def generate_export(path, n_messages, n_channels, url, seed=0):
+    """Write a Slack export with `n_messages` messages to a directory"""
+    rnd = random.Random(seed)
+    users = [{"id": "U{}".format(i), "name": "user{}".format(i)} for i in range(50)]
+    channels = [
+        {"id": "C{}".format(i), "name": "channel{}".format(i), "purpose": {"value": ""}, "topic": {"value": ""}}
+        for i in range(n_channels)
+    ]
+    with open(os.path.join(path, "users.json"), "w") as f:
+        json.dump(users, f)
+    with open(os.path.join(path, "channels.json"), "w") as f:
+        json.dump(channels, f)
+
+    start = datetime(2015, 1, 1, 9)
+    for i, c in enumerate(channels):
+        os.makedirs(os.path.join(path, c["name"]))
+        count = n_messages // n_channels + (i < n_messages % n_channels)
+        threads = []
+        for day in range((count + MESSAGES_PER_DAY - 1) // MESSAGES_PER_DAY):
+            day_start = start + timedelta(days=day)
+            msgs = []
+            for n in range(min(MESSAGES_PER_DAY, count - day * MESSAGES_PER_DAY)):
+                ts = "{}.{:06d}".format(int(day_start.timestamp()) + n * 30, n)
+                msg = {"type": "message", "user": rnd.choice(users)["id"], "text": rnd.choice(TEXTS), "ts": ts}
+                if rnd.random() < 0.05:
+                    msg["reactions"] = [{"name": "+1", "users": ["U1", "U2"], "count": 2}]
+                if rnd.random() < 0.01:
+                    msg["files"] = [{
+                        "id": "F{}".format(ts), "name": "image.png", "title": "image", "filetype": "png",
+                        "size": FILE_SIZE, "url_private": "{}/{}.png".format(url, ts),
+                    }]
+                # Keep threads within a day so the parser can let go of them
+                threads = [t for t in threads if float(t["ts"]) >= day_start.timestamp()]
+                if threads and rnd.random() < 0.2:
+                    parent = rnd.choice(threads)
+                    msg["thread_ts"] = parent["ts"]
+                    parent["reply_count"] = parent.get("reply_count", 0) + 1
+                    parent["latest_reply"] = ts
+                elif rnd.random() < 0.05:
+                    msg["thread_ts"] = ts
+                    threads.append(msg)
+                msgs.append(msg)
+            with open(os.path.join(path, c["name"], day_start.strftime("%Y-%m-%d.json")), "w") as f:
+                json.dump(msgs, f)
+
+
+def bench_parse(path):
+    """Parse every channel, returning the number of messages and the time taken"""
+    count = 0
+    with slack_to_discord.open_export(path) as export:
+        t = time.perf_counter()
+        index = slack_to_discord.WorkspaceIndex.from_export(export)
+        for c, (_, _, pins) in slack_to_discord.slack_channels(export).items():
+            for msg in slack_to_discord.parse_channel(export, index, c, pins):
+                count += 1 + len(msg.replies)
+        return count, time.perf_counter() - t
+
+
+def bench_compile(path, output):
+    """Compile an export, returning the time taken"""
+    with slack_to_discord.SlackExport(path) as export:
+        t = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            slack_to_discord.compile_export(export, output)
+        return time.perf_counter() - t
+
+
+async def bench_import(path, time_scale):
+    """Import into a DryRunGuild, returning it and the time taken"""
+    with slack_to_discord.SlackExport(path) as export, \
+            contextlib.closing(slack_to_discord_client.ImportJournal(":memory:")) as journal:
+        client = slack_to_discord_client.MyClient(
+            export=export, journal=journal, guild_name="benchmark", all_private=False,
+            skip_existing_channels=False, start=None, end=None,
+        )
+        guild = slack_to_discord_client.DryRunGuild("benchmark", time_scale=time_scale)
+        t = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            await client.dry_run(guild)
+        return guild, time.perf_counter() - t
+
+
+async def serve_files():
+    async def handler(request):
+        return web.Response(body=b"\0" * FILE_SIZE, content_type="image/png")
+
+    app = web.Application()
+    app.router.add_get("/{name}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://127.0.0.1:{}".format(port)
+
+
+async def run(sizes, channels, time_scale):
+    runner, url = await serve_files()
+    try:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as path:
+                generate_export(path, size, channels, url)
+
+                count, elapsed = bench_parse(path)
+                print("{} messages: parsed in {:.1f}s ({:.0f} msgs/sec)".format(count, elapsed, count / elapsed))
+
+                compiled = os.path.join(path, "export.compiled.sqlite")
+                elapsed = bench_compile(path, compiled)
+                print("{} messages: compiled in {:.1f}s ({:.1f} MiB)".format(count, elapsed, os.path.getsize(compiled) / (1024 * 1024)))
+                count, elapsed = bench_parse(compiled)
+                print("{} messages: parsed compiled export in {:.1f}s ({:.0f} msgs/sec)".format(count, elapsed, count / elapsed))
+
+                guild, elapsed = await bench_import(path, time_scale)
+                print("{} messages: dry run import in {:.1f}s ({:.0f} msgs/sec)".format(count, elapsed, count / elapsed))
+                totals = {}
+                for counts in guild.counts.values():
+                    for k, v in counts.items():
+                        totals[k] = totals.get(k, 0) + v
+                calls = sum(v for k, v in totals.items() if k not in ("upload", "upload_bytes", "429"))
+                print("  API calls: {} ({:.0f} per channel)".format(calls, calls / len(guild.counts)))
+                summary = guild.summary().splitlines()
+                print("  " + summary[0])
+                print("  " + summary[-1])
+                print()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark importing generated Slack exports without Discord")
+    parser.add_argument("--sizes", help="Numbers of messages to generate exports with (default: %(default)s)", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--channels", help="Number of channels in each export (default: %(default)s)", type=int, default=10)
+    parser.add_argument("--dry-run-speed", help="Simulate Discord's rate limits, with time running this many times faster", type=float, default=None)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.sizes, args.channels, args.dry_run_speed))
+
+
+if __name__ == "__main__":
+    main()
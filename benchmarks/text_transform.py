@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Benchmark converting Slack markup to Discord's on a synthetic corpus
+
+Messages are generated from plain words mixed with mentions, links, emojis
+(with skin tones, dashes and renamed ones) and HTML entities. Each corpus is
+converted by TextTransformer (one pass) and by its convert_multipass (a
+pass each for mentions, links, emojis and entities), checking that both
+give the same output. The best time of a few rounds is shown, each round
+with a new transformer so its memoized conversions start out empty.
+
+Corpora:
+ - realistic: most messages are plain text, the rest have a few tokens
+ - dense: every message has markup in about a sixth of its words
+
+Usage: python benchmarks/text_transform.py [--messages 100000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import slack_to_discord  # noqa: E402
+
+
+WORDS = "the quick brown fox jumps over lazy dog deploy build failed ok thanks".split()
+EMOJIS = [":smile:", ":+1::skin-tone-3:", ":simple-smile:", ":party:", ":thumbsup_all:"]
+ENTITIES = ["&amp;", "&lt;", "&gt;"]
+USERS = 1000
+
+
+def generate_message(rnd, markup):
+    """Make a message where about `markup` of the words are tokens"""
+    parts = []
+    for _ in range(rnd.randrange(3, 40)):
+        r = rnd.random() / markup * 0.17 if markup else 1
+        if r < 0.05:
+            parts.append("<@U{}>".format(rnd.randrange(USERS)))
+        elif r < 0.08:
+            parts.append("<https://example.com/{}|link>".format(rnd.randrange(100)))
+        elif r < 0.14:
+            parts.append(rnd.choice(EMOJIS))
+        elif r < 0.17:
+            parts.append(rnd.choice(ENTITIES))
+        else:
+            parts.append(rnd.choice(WORDS))
+    return " ".join(parts)
+
+
+def generate_corpus(n, dense, seed=0):
+    rnd = random.Random(seed)
+    if dense:
+        return [generate_message(rnd, 0.17) for _ in range(n)]
+    return [generate_message(rnd, 0 if rnd.random() < 0.6 else 0.05) for _ in range(n)]
+
+
+def make_index():
+    users = {"U{}".format(i): "User {}".format(i) for i in range(USERS)}
+    return slack_to_discord.WorkspaceIndex(users, {"C1": "general"}, {"party": "<:party:1>"})
+
+
+def best_time(convert, corpus, rounds):
+    """The best time converting the corpus with a function of a new transformer"""
+    best = None
+    for _ in range(rounds):
+        f = convert(slack_to_discord.TextTransformer(make_index()))
+        t = time.perf_counter()
+        for text in corpus:
+            f(text)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark converting Slack markup on a synthetic corpus")
+    parser.add_argument("--messages", help="Number of messages in each corpus (default: %(default)s)", type=int, default=100000)
+    parser.add_argument("--rounds", help="Number of times to convert each corpus (default: %(default)s)", type=int, default=3)
+    args = parser.parse_args()
+
+    for name, dense in (("realistic", False), ("dense", True)):
+        corpus = generate_corpus(args.messages, dense)
+        transform = slack_to_discord.TextTransformer(make_index())
+        mismatches = sum(transform(x) != transform.convert_multipass(x) for x in corpus)
+        multi = best_time(lambda x: x.convert_multipass, corpus, args.rounds)
+        single = best_time(lambda x: x, corpus, args.rounds)
+        print("{}: {} messages, multi-pass {:.2f}s, single pass {:.2f}s ({:.1f}x), {} mismatches".format(
+            name, len(corpus), multi, single, multi / single, mismatches
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,6 @@ setup(
     install_requires = [
         "discord2>=2.0.1"
     ],
-    py_modules=["slack_to_discord"],
+    py_modules=["slack_to_discord", "slack_to_discord_client"],
     entry_points={"console_scripts": ["slack-to-discord=slack_to_discord:main"]},
 )
@@ -1,23 +1,34 @@
 import argparse
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import contextlib
-import glob
+import cProfile
+import functools
+import heapq
 import html
 import io
+import itertools
 import json
+import multiprocessing
 import os
+import pickle
+import posixpath
 import re
+import sqlite3
+import sys
 import tempfile
-import urllib
+import threading
+import time
+import urllib.parse
 import zipfile
-from datetime import datetime
-from urllib.parse import urlparse
-
-import discord
-from discord.errors import Forbidden
-from discord.channel import TextChannel
+from datetime import datetime, timedelta
+from types import MappingProxyType
 
 # Restrictions of discord
 MAX_MESSAGE_SIZE = 1800  # actually max size = 2000, but there are technical stuff in our messages (username and date)
+PACKED_MESSAGE_SIZE = 2000  # packed messages are already formatted so can use the full size
 THREAD_NAME_MAX_NSYMBOLS = 100
 THREAD_NAME_MAX_NWORDS = 10  # we split to N words. After that we use slice of first 100 symbols just in case
 
@@ -29,15 +40,65 @@ TIME_FORMAT = "%H:%M"
 # THREAD_FORMAT = ">>>> {date} {time} <**{username}**> {text}"
 THREAD_FORMAT = "{date} {time} <**{username}**> {text}"
 MSG_FORMAT = "{time} <**{username}**> {text}"
+# When posting through webhooks, the username is shown as the name of the poster instead
+WEBHOOK_THREAD_FORMAT = "{date} {time} {text}"
+WEBHOOK_MSG_FORMAT = "{time} {text}"
 ATTACHMENT_TITLE_TEXT = "<*uploaded a file*> {title}"
 ATTACHMENT_ERROR_APPEND = "\n<file thumbnail used due to size restrictions. See original at <{url}>>"
 
 # Create a separator between dates? (None for no)
 DATE_SEPARATOR = "{:-^50}"
 
+# Attachment downloads
+DOWNLOAD_WORKERS = 4  # concurrent downloads
+DOWNLOAD_MEMORY_BUDGET = 256 * 1024 * 1024  # bytes downloaded ahead of time but not yet sent
+DOWNLOAD_LOOKAHEAD = 50  # messages to look ahead of the sender for attachments
+DOWNLOAD_SPOOL_SIZE = 8 * 1024 * 1024  # larger downloads are spooled to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Downloaded attachments are kept on disk between imports (see --attachment-cache)
+ATTACHMENT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Number of channels to import at the same time
+IMPORT_CONCURRENCY = 4
+
+# Number of threads (per bot) to post replies to at the same time as their channels
+THREAD_CONCURRENCY = 8
+
+# Webhooks made to post messages through (see --webhooks)
+WEBHOOK_NAME = "slack-to-discord"
+
+# Channel parsing
+PARSE_WORKERS = min(4, os.cpu_count() or 1)  # processes parsing channels (0 to parse in a thread instead)
+PARSE_AHEAD = 2  # channels to have parsed ahead of the ones being sent
+PARSE_MAX_IN_MEMORY = 1000  # finished messages to hold in memory before spooling them to disk
+
+# Version of the compiled export format (see `slack-to-discord compile`)
+COMPILED_VERSION = 2
+
+# Max size of an upload to Discord (without boosts)
+FILESIZE_LIMIT = 8 * 1024 * 1024
+
+# Timings and progress of an import (see --stats)
+STATS_STAGES = ["parse", "transform", "download", "send", "thread", "ratelimit"]
+STATS_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 30.0)  # upper bounds (seconds) of the histograms
+STATS_INTERVAL = 10.0  # seconds between writing them out
+
+# Discord's rate limits (roughly) as (requests, per seconds), used to simulate and plan for them
+RATE_LIMITS = {
+    "global": (50, 1.0),
+    "send": (5, 5.0),  # per channel/thread
+    "thread": (5, 5.0),  # per channel
+    "pin": (5, 5.0),  # per channel
+    "edit": (2, 600.0),  # per channel
+}
+
 MENTION_RE = re.compile(r"<([@!#])([^>]*?)(?:\|([^>]*?))?>")
 LINK_RE = re.compile(r"<((?:https?|mailto|tel):[A-Za-z0-9_\+\.\-\/\?\,\=\#\:\@\(\)]+)\|([^>]+)>")
 EMOJI_RE = re.compile(r":([^ /<>:]+):(?::skin-tone-(\d):)?")
+# Stands in for the name of a user that wasn't known when parsing (see WorkspaceIndex.mention_name)
+NAME_PLACEHOLDER = "\x00{}\x00"
+NAME_PLACEHOLDER_RE = re.compile("\x00([^\x00]*)\x00")
 
 
 # Map Slack emojis to Discord's versions
@@ -66,36 +127,427 @@ GLOBAL_EMOJI_MAP = {
 }
 
 
+def convert_emoji(e, t, emoji_map):
+    """Convert a Slack emoji name (and optional skin tone) to Discord's version"""
+    # Emojis in the emoji_map already have bounding :'s and can't have skin
+    # tones applied to them so just directly return them.
+    if e in emoji_map:
+        return emoji_map[e]
+
+    # Convert -'s to "_"s except the 1st char (ex. :-1:)
+    # On Slack some emojis use underscores and some use dashes
+    # On Discord everything uses underscores
+    if len(e) > 1 and "-" in e[1:]:
+        e = e[0] + e[1:].replace("-", "_")
+
+    if e in GLOBAL_EMOJI_MAP:
+        e = GLOBAL_EMOJI_MAP[e]
+
+    # Convert Slack's skin tone system to Discord's
+    if t is not None:
+        return ":{}_tone{}:".format(e, int(t)-1)
+    else:
+        return ":{}:".format(e)
+
+
 def emoji_replace(s, emoji_map):
-    def replace(match):
-        e, t = match.groups()
-
-        # Emojis in the emoji_map already have bounding :'s and can't have skin
-        # tones applied to them so just directly return them.
-        if e in emoji_map:
-            return emoji_map[e]
-
-        # Convert -'s to "_"s except the 1st char (ex. :-1:)
-        # On Slack some emojis use underscores and some use dashes
-        # On Discord everything uses underscores
-        if len(e) > 1 and "-" in e[1:]:
-            e = e[0] + e[1:].replace("-", "_")
-
-        if e in GLOBAL_EMOJI_MAP:
-            e = GLOBAL_EMOJI_MAP[e]
-
-        # Convert Slack's skin tone system to Discord's
-        if t is not None:
-            return ":{}_tone{}:".format(e, int(t)-1)
+    return EMOJI_RE.sub(lambda m: convert_emoji(*m.groups(), emoji_map), s)
+
+
+class TextTransformer:
+    """Converts Slack's message markup to Discord's in a single pass
+
+    Mentions, links, emojis and HTML entities are all matched by one regex
+    and converted in one scan of the text. The result is identical to
+    converting mentions, then links, then emojis, then entities in separate
+    passes (`convert_multipass`). The only way they can differ is when an
+    emoji or entity spans the edge of a converted mention/link, so those
+    (rare) messages are detected and handled by the multi-pass version.
+    Emoji and entity conversions are memoized.
+    """
+
+    TOKEN_RE = re.compile(
+        # mentions (see MENTION_RE) and links (see LINK_RE)
+        r"<(?:([@!#])([^>]*?)(?:\|([^>]*?))?"
+        r"|((?:https?|mailto|tel):[A-Za-z0-9_\+\.\-\/\?\,\=\#\:\@\(\)]+)\|([^>]+))>"
+        # emojis (see EMOJI_RE)
+        r"|:([^ /<>:]+):(?::skin-tone-(\d):)?"
+        # HTML entities, as html.unescape finds them (except that they can't
+        # contain a ':' so they can't overlap an emoji)
+        r"|&(?:#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[^\t\n\f <&#;:]{1,32};?)"
+    )
+
+    # Stop memoizing conversions once this many are held
+    CACHE_SIZE = 100000
+
+    def __init__(self, index):
+        self._index = index
+        self._cache = {}
+        self._converted = {}
+        self._reactions = {}
+        self._matches = []
+
+    def __call__(self, text):
+        if "<" not in text and ":" not in text and "&" not in text:
+            return text.rstrip()
+
+        self._matches = matches = []
+        out = self.TOKEN_RE.sub(self._replace, text)
+        if matches and self._needs_multipass(text, matches):
+            return self.convert_multipass(text)
+        return out.rstrip()
+
+    def _replace(self, m):
+        token = m.group()
+        try:
+            r = self._cache[token]
+        except KeyError:
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.clear()
+                self._converted.clear()
+            r = self._convert(m)
+            # Bots are still being discovered so mentions of them can change
+            if m.group(1) != "@" or m.group(2) in self._index.users:
+                self._cache[token] = r
+        if token[0] == "<":
+            self._matches.append(m)
+        return r
+
+    def _convert(self, m):
+        c = m.group(0)[0]
+        if c == ":":
+            r = convert_emoji(m.group(6), m.group(7), self._index.emoji_map)
+            if "&" in r:
+                r = html.unescape(r)
+            return r
+        elif c == "&":
+            return html.unescape(m.group(0))
+
+        r = m.group(4) if m.group(4) is not None else self._mention(m)
+        # a nested '<' would be converted separately by the multi-pass version
+        self._converted[m.group(0)] = None if "<" in m.group(0)[1:] else r
+        if ":" in r:
+            r = emoji_replace(r, self._index.emoji_map)
+        if "&" in r:
+            r = html.unescape(r)
+        return r
+
+    def _needs_multipass(self, text, matches):
+        """Check if converting mentions/links separately would change how the rest is converted"""
+        # Nothing can span a space, which is what mentions/links are usually
+        # surrounded by, so only look closer if one isn't
+        converted = self._converted
+        last = len(text)
+        close_look = False
+        for m in matches:
+            if converted.get(m.group()) is None:
+                # a nested '<' would be converted separately (or the cache
+                # was cleared while converting this text)
+                return True
+            start, end = m.span()
+            if not ((start == 0 or text[start - 1] == " ") and (end == last or text[end] == " ")):
+                close_look = True
+        if not close_look:
+            return False
+
+        # The text as the multi-pass version would have it after converting
+        # mentions and links, with the positions of the converted ones
+        parts = []
+        edges = []
+        pos = size = 0
+        for m in matches:
+            start, end = m.span()
+            r = converted[m.group()]
+            parts.append(text[pos:start])
+            size += start - pos
+            edges.append(size)
+            parts.append(r)
+            size += len(r)
+            edges.append(size)
+            pos = end
+        parts.append(text[pos:])
+        text = "".join(parts)
+        return any(self._spanned(text, x) for x in edges)
+
+    @staticmethod
+    def _spanned(text, i):
+        """Check if an emoji or an entity could span position i of the text"""
+        if not 0 < i < len(text):
+            return False
+
+        # Emojis need a ':' on both sides without any of " /<>" in between
+        left = i - 1
+        while left >= 0 and text[left] not in " /<>:":
+            left -= 1
+        if left >= 0 and text[left] == ":":
+            right = i
+            while right < len(text) and text[right] not in " /<>:":
+                right += 1
+            if right < len(text) and text[right] == ":":
+                return True
+
+        # Entities are at most 34 characters long and can't contain whitespace, '<', ';' or '&'
+        left = i - 1
+        while left >= 0 and i - left <= 34 and text[left] not in "\t\n\f <;&":
+            left -= 1
+        return left >= 0 and text[left] == "&"
+
+    def reaction(self, name):
+        """Convert the name of an emoji used as a reaction"""
+        try:
+            return self._reactions[name]
+        except KeyError:
+            r = self._reactions[name] = emoji_replace(":{}:".format(name), self._index.emoji_map)
+            return r
+
+    def convert_multipass(self, text):
+        text = MENTION_RE.sub(self._mention, text)
+        text = LINK_RE.sub(lambda x: x.group(1), text)
+        text = emoji_replace(text, self._index.emoji_map)
+        text = html.unescape(text)
+        return text.rstrip()
+
+    def _mention(self, m):
+        type_ = m.group(1)
+        target = m.group(2)
+        channel_name = m.group(3)
+
+        if type_ == "#":
+            # Newer exports only have the channel ID
+            return "`#{}`".format(channel_name or self._index.channels.get(target, "unknown-channel"))
+        elif channel_name is not None:
+            return m.group(0)
+
+        if type_ == "@":
+            return "`@{}`".format(self._index.mention_name(target))
+        elif type_ == "!":
+            return "`@{}`".format(target)
+        return m.group(0)
+
+
+class SlackExport:
+    """Read-only access to a Slack export, either the zip file or an extracted directory
+
+    Members are opened lazily straight from the archive so nothing is copied
+    to disk. The day files of every channel are indexed once from the zip's
+    central directory (or a single walk of the directory).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            self._zip = None
+            names = [
+                posixpath.join(*os.path.relpath(os.path.join(root, f), path).split(os.sep))
+                for root, _, files in os.walk(path)
+                for f in files
+            ]
         else:
-            return ":{}:".format(e)
+            self._zip = zipfile.ZipFile(path, 'r')
+            names = self._zip.namelist()
+
+        # Some tools wrap the export in a top-level folder - find it via channels.json
+        self._prefix = ""
+        for name in names:
+            if posixpath.basename(name) == "channels.json" and name.count("/") <= 1:
+                self._prefix = name[:-len("channels.json")]
+                break
+
+        self._channel_files = collections.defaultdict(list)
+        for name in names:
+            if not name.startswith(self._prefix) or not name.endswith(".json"):
+                continue
+            parts = name[len(self._prefix):].split("/")
+            if len(parts) == 2 and parts[0] and parts[1]:
+                self._channel_files[parts[0]].append(name)
+        for files in self._channel_files.values():
+            files.sort(key=posixpath.basename)
+
+    def open(self, name):
+        """Open a member of the export (relative to the export root) for binary reading"""
+        if self._zip is not None:
+            return self._zip.open(self._prefix + name, 'r')
+        return open(os.path.join(self.path, *name.split("/")), 'rb')
+
+    def load_json(self, name):
+        with self.open(name) as fp:
+            return json.load(fp)
+
+    def size(self, name):
+        """The (uncompressed) size of a member of the export"""
+        if self._zip is not None:
+            return self._zip.getinfo(self._prefix + name).file_size
+        return os.path.getsize(os.path.join(self.path, *name.split("/")))
+
+    def channel_files(self, channel_name):
+        """The member names of the per-day JSON files of a channel, in date order"""
+        return [x[len(self._prefix):] for x in self._channel_files.get(channel_name, [])]
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class CompiledExport:
+    """Read-only access to a Slack export compiled by `compile_export`
+
+    Works like a SlackExport (the workspace files are kept as they were and
+    the day files of each channel are listed with their sizes) but the
+    messages of a channel are read already parsed with `messages` instead
+    of from the day files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(path))), uri=True)
+        version = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or int(version[0]) != COMPILED_VERSION:
+            raise ValueError("{} was compiled by a different version, compile the export again".format(path))
+        self._channel_files = collections.defaultdict(list)
+        self._sizes = {}
+        for name, channel, size in self._db.execute("SELECT name, channel, size FROM members ORDER BY name"):
+            self._sizes[name] = size
+            if channel is not None:
+                self._channel_files[channel].append(name)
+
+    @staticmethod
+    def is_compiled(path):
+        """Check if a path is a compiled export (an SQLite database)"""
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as f:
+            return f.read(16) == b"SQLite format 3\x00"
+
+    def open(self, name):
+        row = self._db.execute("SELECT data FROM members WHERE name = ?", (name,)).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError("{} isn't in the compiled export".format(name))
+        return io.BytesIO(row[0])
+
+    def load_json(self, name):
+        with self.open(name) as fp:
+            return json.load(fp)
+
+    def size(self, name):
+        return self._sizes[name]
+
+    def channel_files(self, channel_name):
+        return list(self._channel_files.get(channel_name, []))
+
+    def messages(self, channel_name, emoji_map=None, start=None, end=None, since=None, bots=None):
+        """Read the messages of a channel, as `slack_channel_messages` would parse them
+
+        Only the messages from a day either side of the date range (and the
+        mark of a delta import) are read, like the day files would be. Custom
+        emojis weren't known when the export was compiled so the ones in
+        `emoji_map` are converted as they're read. The bots of the messages
+        read are added to `bots` (as WorkspaceIndex.add_bot would).
+        """
+        mark, thread_marks = since or (None, {})
+        first_day = max(
+            [(x - timedelta(days=1)).isoformat() for x in (start, mark and datetime.fromtimestamp(float(mark)).date()) if x],
+            default="",
+        )
+        last_day = (end + timedelta(days=1)).isoformat() if end else "9999"
+        convert = _custom_emoji_converter(emoji_map) if emoji_map else None
+        found_bots = []
+
+        def load(row):
+            ts, _, username, text, reactions, files, events, bot, bot_name = row
+            if bot is not None:
+                found_bots.append((ts, bot, bot_name))
+            if convert is not None:
+                text = convert(text)
+            if reactions is not None:
+                reactions = {
+                    convert(k) if convert is not None else k: [sys.intern(u) for u in v]
+                    for k, v in json.loads(reactions).items()
+                }
+            return SlackMessage(
+                ts, username, text,
+                reactions=reactions or EMPTY_MAPPING,
+                files=json.loads(files) if files is not None else (),
+                events=json.loads(events) if events is not None else EMPTY_MAPPING,
+            )
+
+        def threads(rows):
+            for root, group in itertools.groupby(rows, key=lambda x: x[1]):
+                yield root, [x for x in group if x[0] == root or x[0] > thread_marks.get(root, "")]
+
+        columns = "ts, root, username, text, reactions, files, events, bot, bot_name"
+        first, last = self._db.execute(
+            "SELECT MIN(ts), MAX(ts) FROM messages WHERE channel = ? AND ts = root AND day BETWEEN ? AND ?",
+            (channel_name, first_day, last_day)
+        ).fetchone()
+        if first is not None:
+            rows = self._db.execute(
+                "SELECT {} FROM messages WHERE channel = ? AND root BETWEEN ? AND ? ORDER BY root, ts".format(columns),
+                (channel_name, first, last)
+            )
+            for root, group in threads(rows):
+                msg = load(group[0])
+                msg.replies = [load(x) for x in group[1:]] or ()
+                yield msg
+
+        if mark:
+            # New replies to messages before the ones read (see slack_channel_messages)
+            first_ts = self._db.execute(
+                "SELECT MIN(ts) FROM messages WHERE channel = ? AND day >= ?", (channel_name, first_day)
+            ).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT {} FROM messages WHERE channel = ? AND ts != root AND day >= ? AND root < ? AND root <= ? "
+                "ORDER BY root, ts".format(columns),
+                (channel_name, first_day, first_ts or "", mark)
+            )
+            for root, group in threads(rows):
+                if group:
+                    yield SlackMessage(root, "", "", replies=[load(x) for x in group], events={"imported": True})
+
+        # (in the order they were posted, like the day files are read)
+        if bots is not None:
+            for _, bot, bot_name in sorted(found_bots):
+                bots.setdefault(bot, bot_name)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def open_export(path):
+    """Open a Slack export (the zip file or an extracted directory) or a compiled one"""
+    if CompiledExport.is_compiled(path):
+        return CompiledExport(path)
+    return SlackExport(path)
+
+
+def _custom_emoji_converter(emoji_map):
+    """Make a function converting custom emojis in text that was converted without them"""
+    # Without the custom emojis, they were converted like any other emoji
+    # (with any skin tone added on)
+    names = {convert_emoji(k, None, {})[1:-1]: v for k, v in emoji_map.items()}
+
+    def replace(m):
+        name = m.group(1)
+        if name not in names:
+            name = re.sub(r"_tone\d$", "", name)
+        return names.get(name, m.group(0))
 
-    return EMOJI_RE.sub(replace, s)
+    return lambda text: EMOJI_RE.sub(replace, text) if ":" in text else text
 
 
-def slack_usermap(d):
-    with open(os.path.join(d, "users.json"), 'rb') as fp:
-        data = json.load(fp)
+def slack_usermap(export):
+    data = export.load_json("users.json")
     r = dict()
     for x in data:
         r[x["id"]] = x.get('real_name', x['name'])
@@ -105,9 +557,81 @@ def slack_usermap(d):
     return r
 
 
-def slack_channels(d):
-    with open(os.path.join(d, "channels.json"), 'rb') as fp:
-        data = json.load(fp)
+class WorkspaceIndex:
+    """Workspace-wide lookups, built once per import and shared by every channel
+
+    Holds the users (from users.json), the channel names by ID (for
+    `<#C...>` mentions) and the custom emoji map. These are read-only. Bots
+    don't have a list in the export so the ones found in the messages of a
+    channel are kept in `found_bots` and merged into `bots` by the process
+    sending them, in the order the channels are sent (see ChannelParser).
+    Mentions of bots that aren't in `bots` yet are left as placeholders
+    while parsing and named by `resolve_names` once they're merged, so the
+    names don't depend on which parse worker got to which channel first.
+    If `bot_messages` is set to a dict, the bot (and name) of each message
+    from one is kept in it by `ts`.
+    """
+
+    def __init__(self, users, channels, emoji_map):
+        self.users = MappingProxyType(users)
+        self.channels = MappingProxyType(channels)
+        self.emoji_map = MappingProxyType(emoji_map)
+        self.bots = {}
+        self.found_bots = {}
+        self.bot_messages = None
+        self.transform = TextTransformer(self)
+
+    def __reduce__(self):
+        return (
+            self.__class__,
+            (dict(self.users), dict(self.channels), dict(self.emoji_map)),
+            {"bots": dict(self.bots)},
+        )
+
+    @classmethod
+    def from_export(cls, export, emoji_map=None):
+        channels = {x["id"]: x["name"] for x in export.load_json("channels.json")}
+        return cls(slack_usermap(export), channels, emoji_map or {})
+
+    def add_bot(self, bot_id, name, ts):
+        self.found_bots.setdefault(bot_id, name)
+        if self.bot_messages is not None:
+            self.bot_messages[ts] = (bot_id, name)
+
+    def merge_bots(self, bots):
+        for bot_id, name in bots.items():
+            self.bots.setdefault(bot_id, name)
+
+    def username(self, user_id):
+        if user_id in self.users:
+            return self.users[user_id]
+        if user_id in self.bots:
+            return self.bots[user_id]
+        return self.found_bots.get(user_id, "[unknown]")
+
+    def mention_name(self, user_id):
+        """The name of a user, or a placeholder if it isn't in the users or `bots`"""
+        if user_id in self.users:
+            return self.users[user_id]
+        if user_id in self.bots:
+            return self.bots[user_id]
+        return NAME_PLACEHOLDER.format(user_id)
+
+    def resolve_names(self, msg):
+        """Name the users left as placeholders in a parsed message and its replies"""
+        resolve = lambda m: self.bots.get(m.group(1), "[unknown]")
+        for x in (msg, *msg.replies):
+            if "\x00" in x.username:
+                x.username = sys.intern(NAME_PLACEHOLDER_RE.sub(resolve, x.username))
+            if "\x00" in x.text:
+                x.text = NAME_PLACEHOLDER_RE.sub(resolve, x.text)
+            for data in x.plan:
+                if "\x00" in data["content"]:
+                    data["content"] = NAME_PLACEHOLDER_RE.sub(resolve, data["content"])
+
+
+def slack_channels(export):
+    data = export.load_json("channels.json")
 
     topic = lambda x: "\n\n".join([x[k]["value"] for k in ("purpose", "topic") if x[k]["value"]])
     pins = lambda x: set(p["id"] for p in x.get("pins", []))
@@ -145,44 +669,223 @@ def slack_filedata(f):
         thumbs.append(f["thumb_video"])
 
     return {
+        "id": f.get("id"),
         "name": "{}.{}".format(name, ext),
         "title": f["title"],
         "url": f["url_private"],
+        "size": f.get("size"),
         "thumbs": thumbs
     }
 
 
-def slack_channel_messages(d, channel_name, emoji_map, pins):
-    users = slack_usermap(d)
+def export_file_date(name):
+    """The date of a per-day export file (None if it isn't named like one)"""
+    try:
+        return datetime.strptime(posixpath.basename(name), "%Y-%m-%d.json").date()
+    except ValueError:
+        return None
+
+
+def latest_reply_ts(d):
+    """The timestamp of the latest reply to a Slack message (0 if none, inf if unknown)"""
+    if "latest_reply" in d:
+        return float(d["latest_reply"])
+    if d.get("replies"):
+        return max(float(x["ts"]) for x in d["replies"])
+    if d.get("reply_count"):
+        return float("inf")
+    return 0.0
+
+
+# Shared by every message that doesn't have any reactions or events
+EMPTY_MAPPING = MappingProxyType({})
+
+
+class SlackMessage:
+    """A parsed Slack message
+
+    This is what the parser hands to the sender so it's kept small: the date
+    and time are only formatted when needed, usernames are interned and
+    messages without replies, reactions, files or events share the same
+    empty containers. When the message will be sent, `plan` holds the
+    Discord messages to send for it (see `make_discord_msgs`) and, if short
+    messages were merged into it, `packed` holds them (see `pack_messages`).
+    """
+
+    __slots__ = ("ts", "username", "text", "replies", "reactions", "files", "events", "packed", "plan")
+
+    def __init__(self, ts, username, text, *, replies=(), reactions=EMPTY_MAPPING, files=(), events=EMPTY_MAPPING):
+        self.ts = ts
+        self.username = sys.intern(username)
+        self.text = text
+        self.replies = replies
+        self.reactions = reactions
+        self.files = files
+        self.events = events
+        self.packed = ()
+        self.plan = ()
+
+    def __getstate__(self):
+        return tuple(None if x is EMPTY_MAPPING else x for x in (getattr(self, k) for k in self.__slots__))
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, EMPTY_MAPPING if v is None else v)
+        # Keep usernames shared after being read back from a worker
+        self.username = sys.intern(self.username)
+        if self.reactions:
+            self.reactions = {k: [sys.intern(u) for u in v] for k, v in self.reactions.items()}
+
+    def __repr__(self):
+        return "<SlackMessage ts={} username={!r}>".format(self.ts, self.username)
+
+    @property
+    def datetime(self):
+        return datetime.fromtimestamp(float(self.ts))
+
+    @property
+    def date(self):
+        return self.datetime.strftime(DATE_FORMAT)
+
+    @property
+    def time(self):
+        return self.datetime.strftime(TIME_FORMAT)
+
+    def format(self, fmt, text=None):
+        """Format the message (or some other text in its place) with MSG_FORMAT/THREAD_FORMAT"""
+        dt = self.datetime
+        return fmt.format(
+            date=dt.strftime(DATE_FORMAT),
+            time=dt.strftime(TIME_FORMAT),
+            username=self.username,
+            text=self.text if text is None else text,
+        )
 
-    def mention_repl(m):
-        type_ = m.group(1)
-        target = m.group(2)
-        channel_name = m.group(3)
+    def copy(self, **changes):
+        new = SlackMessage.__new__(SlackMessage)
+        for k in self.__slots__:
+            setattr(new, k, changes.get(k, getattr(self, k)))
+        return new
+
+
+class MessageSpool:
+    """Top-level messages of a channel waiting to be yielded in order
+
+    Messages are added in order along with the timestamp of the last reply
+    they expect. Those with replies still to come (open threads) are held in
+    memory and given a dict of replies (by timestamp) to add them to. Once a
+    thread is complete (or a message didn't have one), it's finished and is
+    spooled to a temporary file if more than `max_in_memory` finished
+    messages are already held. That way memory use depends on the number of
+    open threads, not on how many messages are stuck behind a long-running
+    thread.
+    """
+
+    def __init__(self, max_in_memory=PARSE_MAX_IN_MEMORY):
+        self._max_in_memory = max_in_memory
+        self._order = collections.deque()
+        self._open = {}
+        self._closes = []
+        self._finished = {}
+        self._spooled = {}
+        self._file = None
+
+    def add(self, msg, latest_reply):
+        self._order.append(msg.ts)
+        if latest_reply > float(msg.ts):
+            msg.replies = {}
+            self._open[msg.ts] = msg
+            heapq.heappush(self._closes, (latest_reply, msg.ts))
+        else:
+            self._finish(msg)
+
+    def get_open(self, ts):
+        """Get the message with an open thread (None if it isn't one)"""
+        return self._open.get(ts)
+
+    def advance(self, ts):
+        """Finish every thread that has seen its last reply by a timestamp, yielding any messages now in order"""
+        while self._closes and self._closes[0][0] <= ts:
+            _, parent = heapq.heappop(self._closes)
+            self._finish(self._open.pop(parent))
+        while self._order and self._order[0] not in self._open:
+            yield self._pop(self._order.popleft())
+
+    def finish(self):
+        """Finish every message, yielding all of them (in order)"""
+        yield from self.advance(float("inf"))
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _finish(self, msg):
+        if len(self._finished) < self._max_in_memory:
+            self._finished[msg.ts] = msg
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        self._file.seek(0, io.SEEK_END)
+        self._spooled[msg.ts] = self._file.tell()
+        pickle.dump(msg, self._file, pickle.HIGHEST_PROTOCOL)
+
+    def _pop(self, ts):
+        if ts in self._finished:
+            return self._finished.pop(ts)
+        self._file.seek(self._spooled.pop(ts))
+        return pickle.load(self._file)
+
+
+def slack_channel_messages(export, channel_name, index, pins, start=None, end=None, since=None):
+    """Parse the messages of a channel, yielding each one once its thread is complete
+
+    Reading stops at the end of the date range once every thread started in
+    it has had its last reply (as given by Slack's latest_reply/replies/
+    reply_count metadata). Replies that arrive after their thread was
+    finished (or that don't have a parent) are skipped.
+
+    For a delta import, `since` is the mark left by the import before it
+    (see ImportJournal.mark): the `ts` of the last message it imported and
+    of the last reply it imported to each thread. Day files before the mark
+    aren't read, and replies it already imported are skipped. New replies to
+    messages from those files are yielded at the end, in the replies of a
+    message with only its `ts` and an "imported" event (it isn't sent
+    again).
+    """
+    transform = index.transform
+    mark, thread_marks = since or (None, {})
+    mark_day = datetime.fromtimestamp(float(mark)).date() if mark else None
+
+    messages = MessageSpool()
+    imported = {}
+    first_ts = None
+    file_ts_map = {}
+    replies_until = 0.0
+    for file in export.channel_files(channel_name):
+        # Skip the day files outside of the date range without reading them.
+        # Files are named by date in the workspace's timezone so give a day of
+        # leeway either side (the exact range is checked by the caller). Files
+        # after the range are only needed for replies to messages in it.
+        replies_only = False
+        day = export_file_date(file)
+        if day is not None:
+            if start and day < start - timedelta(days=1):
+                continue
+            if mark_day and day < mark_day - timedelta(days=1):
+                continue
+            if end and day > end + timedelta(days=1):
+                if replies_until != float("inf") and day > datetime.fromtimestamp(replies_until).date() + timedelta(days=1):
+                    break
+                replies_only = True
 
-        if type_ == "#":
-            return "`#{}`".format(channel_name)
-        elif channel_name is not None:
-            return m.group(0)
+        data = sorted(export.load_json(file), key=lambda x: x["ts"])
+        data_last_ts = data[-1]["ts"] if data else "0"
+        if first_ts is None and data:
+            first_ts = data[0]["ts"]
+        for d in data:
+            if replies_only and d.get("thread_ts", d["ts"]) == d["ts"]:
+                continue
 
-        if type_ == "@":
-            return "`@{}`".format(users.get(target, "[unknown]"))
-        elif type_ == "!":
-            return "`@{}`".format(target)
-        return m.group(0)
-
-    messages = {}
-    file_ts_map = {}
-    for file in sorted(glob.glob(os.path.join(d, channel_name, "*.json"))):
-        with open(file, 'rb',) as fp:
-            data = json.load(fp)
-        for d in sorted(data, key=lambda x: x["ts"]):
-            text = d["text"]
-            text = MENTION_RE.sub(mention_repl, text)
-            text = LINK_RE.sub(lambda x: x.group(1), text)
-            text = emoji_replace(text, emoji_map)
-            text = html.unescape(text)
-            text = text.rstrip()
+            text = transform(d["text"])
 
             ts = d["ts"]
 
@@ -191,11 +894,15 @@ def slack_channel_messages(d, channel_name, emoji_map, pins):
             files = d.get("files", [])
             thread_ts = d.get("thread_ts", ts)
             events = {}
+            username = None
 
-            # add bots to user map as they're discovered
-            if subtype.startswith("bot_") and "bot_id" in d and d["bot_id"] not in users:
-                users[d["bot_id"]] = d.get("username", "[unknown bot]")
+            # add bots to the index (for mentions) as they're discovered, but
+            # use the name each message was posted under since integrations
+            # can post under many names with the same bot
+            if subtype.startswith("bot_") and "bot_id" in d:
+                index.add_bot(d["bot_id"], d.get("username", "[unknown bot]"), ts)
                 user_id = d["bot_id"]
+                username = d.get("username")
 
             # Treat file comments as threads started on the message that posted the file
             elif subtype == "file_comment":
@@ -236,39 +943,59 @@ def slack_channel_messages(d, channel_name, emoji_map, pins):
             for f in files:
                 file_ts_map[f["id"]] = ts
 
-            dt = datetime.fromtimestamp(float(ts))
-            msg = {
-                "username": users.get(user_id, "[unknown]"),
-                "datetime": dt,
-                "time": dt.strftime(TIME_FORMAT),
-                "date": dt.strftime(DATE_FORMAT),
-                "text": text,
-                "replies": {},
-                "reactions": {
-                    emoji_replace(":{}:".format(x["name"]), emoji_map): [
-                        users.get(u, "[unknown]").replace("_", "\\_")
+            msg = SlackMessage(
+                ts,
+                username or index.mention_name(user_id),
+                text,
+                reactions={
+                    transform.reaction(x["name"]): [
+                        sys.intern(index.username(u).replace("_", "\\_"))
                         for u in x["users"]
                     ]
-                    for x in d.get("reactions", [])
-                },
-                "files": [slack_filedata(f) for f in files if "filetype" in f],
-                "events": events
-            }
+                    for x in d["reactions"]
+                } if d.get("reactions") else EMPTY_MAPPING,
+                files=[slack_filedata(f) for f in files if "filetype" in f] or (),
+                events=events or EMPTY_MAPPING,
+            )
 
             # If this is a reply, add it to the parent message's replies
             # Replies have a "thread_ts" that differs from their "ts"
             if thread_ts != ts:
-                if thread_ts not in messages:
-                    # Orphan thread message - skip it
+                if ts <= thread_marks.get(thread_ts, ""):
+                    # Already imported
                     continue
-                messages[thread_ts]["replies"][ts] = msg
+                parent = messages.get_open(thread_ts)
+                if parent is None and mark and thread_ts <= mark and thread_ts < first_ts:
+                    # A reply to a message in a day file that wasn't read
+                    if thread_ts not in imported:
+                        imported[thread_ts] = SlackMessage(thread_ts, "", "", replies={}, events={"imported": True})
+                    parent = imported[thread_ts]
+                if parent is not None:
+                    parent.replies[ts] = msg
+                # Otherwise it's an orphan thread message (or a late one) - skip it
             else:
-                messages[ts] = msg
+                # File comments don't have any metadata to say when they end so
+                # keep the thread open while their file's message is in the same day file
+                latest_reply = latest_reply_ts(d)
+                if files and not latest_reply:
+                    latest_reply = float(data_last_ts)
+                messages.add(msg, latest_reply)
+                day = msg.datetime.date()
+                if not (start and day < start or end and day > end):
+                    replies_until = max(replies_until, latest_reply)
 
-    # Sort the dicts by timestamp and yield the messages
-    for msg in (messages[x] for x in sorted(messages.keys())):
-        msg["replies"] = [msg["replies"][x] for x in sorted(msg["replies"].keys())]
-        yield msg
+            yield from (sort_replies(x) for x in messages.advance(float(ts)))
+
+    yield from (sort_replies(x) for x in messages.finish())
+    yield from (sort_replies(imported[x]) for x in sorted(imported))
+
+
+def sort_replies(msg):
+    if msg.replies:
+        msg.replies = [msg.replies[x] for x in sorted(msg.replies.keys())]
+    else:
+        msg.replies = ()
+    return msg
 
 
 def split_message(full_text: str):
@@ -279,19 +1006,80 @@ def split_message(full_text: str):
     return text_chunks
 
 
-def make_discord_msgs(msg: dict, is_reply):
+def pack_messages(messages, is_reply=False, split=None):
+    """Merge runs of consecutive short messages into single posts
+
+    Only plain text messages from the same day are merged (no files,
+    reactions, pins, topic changes or threads). Each one keeps its own
+    formatted line in the merged post, which is yielded as a copy of the
+    first message with the merged ones in its `packed` list. Messages up to
+    the `ts` given as `split` (already sent by an earlier import) aren't
+    merged with the ones after it.
+    """
     msg_fmt = (THREAD_FORMAT if is_reply else MSG_FORMAT)
-    
+
+    def flush(run):
+        if len(run) == 1:
+            return run
+        return [run[0].copy(packed=run)]
+
+    run, size = [], 0
+    for msg in messages:
+        line = None
+        if (
+            msg.text and len(msg.text) <= MAX_MESSAGE_SIZE and
+            not (msg.files or msg.reactions or msg.events or msg.replies)
+        ):
+            line = msg.format(msg_fmt)
+
+        if (
+            line is not None and run and run[0].date == msg.date and size + 1 + len(line) <= PACKED_MESSAGE_SIZE and
+            not (split is not None and run[-1].ts <= split < msg.ts)
+        ):
+            run.append(msg)
+            size += 1 + len(line)
+            continue
+
+        yield from flush(run) if run else ()
+        if line is None:
+            yield msg
+            run, size = [], 0
+        else:
+            run, size = [msg], len(line)
+
+    yield from flush(run) if run else ()
+
+
+def message_count(msg):
+    """The number of Slack messages a (possibly packed) message is made of"""
+    return len(msg.packed) or 1
+
+
+def last_ts(msg):
+    """The `ts` of the last Slack message a (possibly packed) message is made of"""
+    return msg.packed[-1].ts if msg.packed else msg.ts
+
+
+def make_discord_msgs(msg: SlackMessage, is_reply, usernames=True):
+    # Packed messages are from different users so always have their usernames
+    if msg.packed:
+        msg_fmt = (THREAD_FORMAT if is_reply else MSG_FORMAT)
+        yield {"content": "\n".join(m.format(msg_fmt) for m in msg.packed)}
+        return
+
+    if usernames:
+        msg_fmt = (THREAD_FORMAT if is_reply else MSG_FORMAT)
+    else:
+        msg_fmt = (WEBHOOK_THREAD_FORMAT if is_reply else WEBHOOK_MSG_FORMAT)
+
     # Split long message and 
-    full_text = msg.get("text")
+    full_text = msg.text
     msg_len = len(full_text)
     if msg_len > MAX_MESSAGE_SIZE:
         text_chunks = split_message(full_text)
 
         # Send first chunk with date and username
-        sub_msg = msg.copy()
-        sub_msg["text"] = text_chunks[0]
-        yield {"content": msg_fmt.format(**sub_msg)}
+        yield {"content": msg.format(msg_fmt, text=text_chunks[0])}
 
         # Send other chunks without date and username except last chunk
         for text_chunk in text_chunks[1:-1]:
@@ -299,240 +1087,820 @@ def make_discord_msgs(msg: dict, is_reply):
 
         # further code will process only last chunk, 
         # i.e. attachments and reactions will be attibuted to last message chunk
-        msg["text"] = text_chunks[-1]
+        msg.text = text_chunks[-1]
 
-    # Show reactions listed in an embed
+    # Show reactions listed in an embed (made into a discord.Embed when it's sent)
     embed = None
-    if msg["reactions"]:
-        embed = discord.Embed(
-            description="\n".join(
-                "{} {}".format(k, ", ".join(v)) for k, v in msg["reactions"].items()
+    if msg.reactions:
+        embed = {
+            "description": "\n".join(
+                "{} {}".format(k, ", ".join(v)) for k, v in msg.reactions.items()
             )
-        )
+        }
 
     # Send the original message without any files
-    if len(msg["files"]) == 1:
+    if len(msg.files) == 1:
         # if there is a single file attached, put reactions on the the file
-        if msg.get("text"):
+        if msg.text:
             yield {
-                "content": msg_fmt.format(**msg),
+                "content": msg.format(msg_fmt),
             }
-    elif msg.get("text") or embed:
+    elif msg.text or embed:
         # for no/multiple files, put reactions on the message (even if blank)
         yield {
-            "content": msg_fmt.format(**msg),
+            "content": msg.format(msg_fmt),
             "embed": embed,
         }
         embed = None
 
     # Send one messge per image that was posted (using the picture title as the message)
-    for f in msg["files"]:
+    for f in msg.files:
         yield {
-            "content": msg_fmt.format(**{**msg, "text": ATTACHMENT_TITLE_TEXT.format(**f)}),
+            "content": msg.format(msg_fmt, text=ATTACHMENT_TITLE_TEXT.format(**f)),
             "file_data": f,
             "embed": embed
         }
         embed = None
 
 
-def file_upload_attempts(data):
-    # Files that are too big cause issues
-    # yield data to try to send (original, then thumbnails)
-    fd = data.pop("file_data", None)
-    if not fd:
-        yield data
-        return
-
-    for i, url in enumerate([fd["url"]] + fd.get("thumbs", [])):
-        if i > 0:
-            # Trying thumbnails - get the filename from Slack (it has the correct extension)
-            filename = urlparse(url).path.rsplit("/", 1)[-1]
-        else:
-            filename = fd["name"]
-
-        try:
-            f = discord.File(
-                fp=io.BytesIO(urllib.request.urlopen(url).read()),
-                filename=filename
-            )
-        except Exception:
-            pass
-        else:
-            yield {
-                **data,
-                "file": f
-            }
-
-        # The original URL failed - trying thumbnails
-        if i < 1:
-            data["content"] += ATTACHMENT_ERROR_APPEND.format(**fd)
+def _until(messages, end):
+    for msg in messages:
+        if "imported" in msg.events:
+            msg.replies = [x for x in msg.replies if x.datetime.date() <= end]
+            if msg.replies:
+                yield msg
+        elif msg.datetime.date() <= end:
+            yield msg
 
-    print("Failed to upload file for message '{}'".format(data["content"]))
 
-    # Just post the message without the attachment
-    yield data
+def channel_messages(export, index, channel_name, pins, start=None, end=None, pack=False, since=None):
+    """Parse the messages of a channel that will be sent
 
+    Messages before `start` and after `end` are left out and, if `pack` is
+    set, short ones are merged. See `slack_channel_messages` for `since`.
+    A compiled export already has the pins in its messages.
+    """
+    if isinstance(export, CompiledExport):
+        messages = export.messages(
+            channel_name, index.emoji_map, start=start, end=end, since=since, bots=index.found_bots
+        )
+    else:
+        messages = slack_channel_messages(export, channel_name, index, pins, start=start, end=end, since=since)
+    # skip messages that are too early or too late (the replies to messages
+    # from an earlier import come last, and are kept up to the end)
+    if start:
+        messages = (x for x in messages if x.datetime.date() >= start or "imported" in x.events)
+    if end:
+        messages = _until(messages, end)
+    if pack:
+        messages = pack_messages(messages, split=since[0] if since else None)
+
+    for msg in messages:
+        if pack:
+            msg.replies = list(pack_messages(msg.replies, is_reply=True))
+        yield msg
 
-class MyClient(discord.Client):
 
-    def __init__(self, *args, data_dir, guild_name, all_private, skip_existing_channels, start, end, **kwargs):
-        self._data_dir = data_dir
-        self._guild_name = guild_name
-        self._prev_msg = None
-        self._all_private = all_private
-        self._skip_existing_channels = skip_existing_channels,
-        self._start, self._end = [datetime.strptime(x, DATE_FORMAT).date() if x else None for x in (start, end)]
+def parse_channel(export, index, channel_name, pins, start=None, end=None, pack=False, usernames=True, since=None):
+    """Parse a channel, yielding the messages to send
 
-        self._started = False # TODO: async equiv of a threading.event
-        super().__init__(*args, **kwargs)
+    As `channel_messages`, with the Discord messages to send for each one
+    (the output of `make_discord_msgs`) stored in its `plan`.
+    """
+    for msg in channel_messages(export, index, channel_name, pins, start=start, end=end, pack=pack, since=since):
+        for rmsg in msg.replies:
+            rmsg.plan = list(make_discord_msgs(rmsg, True, usernames))
+        if "imported" not in msg.events:
+            msg.plan = list(make_discord_msgs(msg, False, usernames))
+        yield msg
 
-    async def on_ready(self):
-        if self._started:
-            return
 
-        print("Done!")
+class ImportStats:
+    """Timings of the stages of an import and the progress of its channels
+
+    Each stage (see STATS_STAGES) has a histogram of how long it took each
+    time (per bucket of STATS_BUCKETS), with the count and total time.
+    Events like retries are counted. Parsing a channel includes transforming
+    its text, and sending includes any waits discord.py makes for rate
+    limits (which are also in the ratelimit stage).
+
+    Progress is tracked by the Discord messages planned for each channel
+    once it's parsed and the ones sent so far (date separators aren't
+    counted). Messages skipped when resuming aren't counted as planned or
+    sent. The ETA comes from the rate of sending so far, with channels
+    that aren't parsed yet estimated from the size of their files. Parse
+    workers send their stats back to be added in with `merge`.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.histograms = {x: [0] * (len(STATS_BUCKETS) + 1) for x in STATS_STAGES}
+        self.seconds = collections.Counter()
+        self.counters = collections.Counter()
+        self.channels = {}
+
+    def observe(self, stage, seconds):
+        self.histograms[stage][bisect.bisect_left(STATS_BUCKETS, seconds)] += 1
+        self.seconds[stage] += seconds
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        t = time.perf_counter()
         try:
-            g = discord.utils.get(self.guilds, name=self._guild_name)
-            if g is None:
-                print("Guild {} not accessible to bot".format(self._guild_name))
-                print("Available guilds:\n{}\n".format(self.guilds))
-                return
-
-            await self._run_import(g)
+            yield
         finally:
-            print("Bot logging out")
-            await self.close()
-
-
-    async def _send_slack_msg(self, channel: TextChannel, msg, thread=None):
-        is_reply = bool(thread)
-
-        if not is_reply and DATE_SEPARATOR:
-            msg_date = msg["date"]
-            if (
-                not self._prev_msg or
-                self._prev_msg["date"] != msg_date
-            ):
-                await channel.send(content=DATE_SEPARATOR.format(msg_date))
-            self._prev_msg = msg
-
-        message_obj = None
-        pin = msg["events"].pop("pin", False)
-        for data in make_discord_msgs(msg, is_reply):
-            for attempt in file_upload_attempts(data):
-                with contextlib.suppress(Exception):
-                    if is_reply:
-                        message_obj = await thread.send(**attempt)
-                    else:
-                        message_obj = await channel.send(**attempt)
-                    if pin:
-                        pin = False
-                        # Requires the "manage messages" optional permission
-                        with contextlib.suppress(Forbidden):
-                            await message_obj.pin()
-                    break
-            else:
-                print("Failed to post message: '{}'\n".format(data["content"]))
-        if is_reply:
-            message_obj = None
-
-        return message_obj
-
-    async def _run_import(self, g):
-        self._started = True
-        emoji_map = {x.name: str(x) for x in self.emojis}
+            self.observe(stage, time.perf_counter() - t)
+
+    def count(self, event, n=1):
+        self.counters[event] += n
+
+    def merge(self, other):
+        for stage, counts in other.histograms.items():
+            self.histograms[stage] = [a + b for a, b in zip(self.histograms[stage], counts)]
+        self.seconds.update(other.seconds)
+        self.counters.update(other.counters)
+
+    def add_channel(self, name, size):
+        """Start tracking a channel with files of `size` bytes"""
+        self.channels[name] = {"size": size, "planned": None, "sent": 0, "skipped": 0, "started": None}
+
+    def planned(self, name, sends):
+        self.channels[name]["planned"] = sends
+
+    def sent(self, name, n=1):
+        channel = self.channels[name]
+        if channel["started"] is None:
+            channel["started"] = time.monotonic()
+        channel["sent"] += n
+
+    def skipped(self, name, n=1):
+        """Count planned messages that were already sent (by an import being resumed)"""
+        self.channels[name]["skipped"] += n
+
+    def progress(self):
+        """The overall and per-channel progress as {"sent", "planned", "eta"} (ETAs in seconds, None if unknown)"""
+        now = time.monotonic()
+        # Messages sent by an earlier (resumed) import aren't planned for this one
+        planned = {
+            name: x["planned"] - x["skipped"] for name, x in self.channels.items() if x["planned"] is not None
+        }
+        sends_per_byte = sum(planned.values()) / max(1, sum(self.channels[x]["size"] for x in planned))
+
+        def eta(remaining, sent, started):
+            if not remaining:
+                return 0.0
+            if not sent or started is None or now <= started:
+                return None
+            return remaining * (now - started) / sent
+
+        channels = {}
+        total_planned = total_sent = 0
+        for name, x in self.channels.items():
+            estimate = planned[name] if name in planned else round(x["size"] * sends_per_byte)
+            total_planned += estimate
+            total_sent += x["sent"]
+            if x["sent"] and name in planned and x["sent"] < planned[name]:
+                channels[name] = {
+                    "sent": x["sent"], "planned": planned[name],
+                    "eta": eta(planned[name] - x["sent"], x["sent"], x["started"]),
+                }
+        started = min((x["started"] for x in self.channels.values() if x["started"] is not None), default=None)
+        return {
+            "sent": total_sent, "planned": total_planned,
+            "eta": eta(max(0, total_planned - total_sent), total_sent, started),
+            "channels": channels,
+        }
 
-        print("Importing messages...")
-        c_chan, c_msg, start_time = 0, 0, datetime.now()
+    def snapshot(self):
+        return {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "elapsed": round(time.monotonic() - self.start_time, 3),
+            "stages": {
+                x: {"count": sum(self.histograms[x]), "seconds": round(self.seconds[x], 6), "buckets": self.histograms[x]}
+                for x in STATS_STAGES
+            },
+            "buckets": list(STATS_BUCKETS),
+            "counters": dict(self.counters),
+            "progress": self.progress(),
+        }
 
-        existing_channels = {x.name: x for x in g.text_channels}
+    def prometheus(self):
+        """The stats in Prometheus' text format"""
+        lines = ["# TYPE slack_to_discord_stage_seconds histogram"]
+        for stage in STATS_STAGES:
+            total = 0
+            for le, n in zip([*STATS_BUCKETS, "+Inf"], self.histograms[stage]):
+                total += n
+                lines.append('slack_to_discord_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, le, total))
+            lines.append('slack_to_discord_stage_seconds_sum{{stage="{}"}} {}'.format(stage, self.seconds[stage]))
+            lines.append('slack_to_discord_stage_seconds_count{{stage="{}"}} {}'.format(stage, total))
+        lines.append("# TYPE slack_to_discord_events_total counter")
+        for event, n in sorted(self.counters.items()):
+            lines.append('slack_to_discord_events_total{{event="{}"}} {}'.format(event, n))
+        progress = self.progress()
+        for name in ("sent", "planned", "eta"):
+            lines.append("# TYPE slack_to_discord_{} gauge".format(name))
+            if progress[name] is not None:
+                lines.append("slack_to_discord_{} {}".format(name, progress[name]))
+            for channel, x in sorted(progress["channels"].items()):
+                if x[name] is not None:
+                    lines.append('slack_to_discord_{}{{channel="{}"}} {}'.format(name, channel.replace('"', '\\"'), x[name]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the stats out, replacing a Prometheus text file (*.prom) or adding a line to a JSON lines file"""
+        if path.endswith(".prom"):
+            with open(path + ".tmp", "w") as f:
+                f.write(self.prometheus())
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+    def format_progress(self):
+        progress = self.progress()
+        return "Progress: {}/{} messages sent, ETA {}".format(
+            progress["sent"], progress["planned"],
+            "unknown" if progress["eta"] is None else timedelta(seconds=round(progress["eta"]))
+        )
 
-        for c, (init_topic, is_private, pins) in slack_channels(self._data_dir).items():
-            if self._skip_existing_channels and c in existing_channels:
-                print("Pass existing channel '{}'".format(c))
-                continue 
+    def format(self):
+        """Make a table of the time taken by each stage"""
+        rows = [["stage", "count", "seconds", "mean ms"]]
+        for stage in STATS_STAGES:
+            count = sum(self.histograms[stage])
+            rows.append([
+                stage, str(count), "{:.1f}".format(self.seconds[stage]),
+                "{:.2f}".format(self.seconds[stage] * 1000 / count) if count else "-",
+            ])
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        lines = [
+            "  ".join(x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(r, widths)))
+            for r in rows
+        ]
+        if self.counters:
+            lines.append(", ".join("{}: {}".format(k, v) for k, v in sorted(self.counters.items())))
+        return "\n".join(lines)
+
+    async def report(self, path=None, interval=STATS_INTERVAL):
+        """Show the progress (and write the stats out to `path`) every `interval` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            if path:
+                self.write(path)
+            print(self.format_progress())
+
+
+class _TimedTransform:
+    """Wraps a TextTransformer to time it"""
+
+    def __init__(self, transform, stats):
+        self._transform = transform
+        self._stats = stats
+
+    def __call__(self, text):
+        t = time.perf_counter()
+        try:
+            return self._transform(text)
+        finally:
+            self._stats.observe("transform", time.perf_counter() - t)
+
+    def __getattr__(self, name):
+        return getattr(self._transform, name)
+
+
+# State of a channel parsing worker (see ChannelParser), kept per thread so
+# the parsers of several bots parsing in threads don't share it
+_parse_worker = threading.local()
+
+
+def _init_parse_worker(path, index):
+    _parse_worker.export = open_export(path)
+    _parse_worker.index = index
+
+
+def _parse_channel_in_worker(spool_dir, channel_name, *args, bots=None, stats=False, profile_dir=None, **kwargs):
+    """Parse a channel to a file, returning its path, the number of Discord messages to send, the stats (if wanted) and the bots found"""
+    index = _parse_worker.index
+    index.merge_bots(bots or {})
+    index.found_bots = {}
+    transform = index.transform
+    parse_stats = ImportStats() if stats else None
+    if parse_stats is not None:
+        index.transform = _TimedTransform(transform, parse_stats)
+    profile = cProfile.Profile() if profile_dir else None
+    sends = 0
+    t = time.perf_counter()
+    try:
+        if profile is not None:
+            profile.enable()
+        # Stream the messages to a file instead of returning them so neither
+        # process has to hold the whole channel in memory
+        with tempfile.NamedTemporaryFile(dir=spool_dir, suffix=".pickle", delete=False) as f:
+            for msg in parse_channel(_parse_worker.export, index, channel_name, *args, **kwargs):
+                sends += len(msg.plan) + sum(len(x.plan) for x in msg.replies)
+                pickle.dump(msg, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        index.transform = transform
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(os.path.join(profile_dir, "{}.prof".format(channel_name)))
+    if parse_stats is not None:
+        parse_stats.observe("parse", time.perf_counter() - t)
+    return f.name, sends, parse_stats, index.found_bots
+
+
+def _read_parsed(path, index):
+    try:
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    msg = pickle.load(f)
+                except EOFError:
+                    return
+                index.resolve_names(msg)
+                yield msg
+    finally:
+        # (the file is already gone if the parser was closed first)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+class ChannelParser:
+    """Parses channels in worker processes, ahead of sending them
+
+    Channels are submitted in the order they will be sent, with at most
+    `ahead` of them parsed (or being parsed) and not yet `done` with, so
+    parsing runs alongside the network sender without holding every channel
+    in memory. Parsed messages are spooled to temporary files and read back
+    one at a time as they're sent. With `workers=0` a single thread is used
+    instead of processes. For a delta import, `since` maps channels to their
+    marks (see `slack_channel_messages`). With `stats` (an ImportStats), the
+    parse stats and the sends planned for each channel are added to it and
+    with a `profile_dir`, a cProfile of parsing each channel is saved there.
+
+    The bots found in each channel are merged into `index` as the channel
+    is read back, and the workers are given the ones merged so far with
+    each channel they parse (see WorkspaceIndex).
+    """
+
+    def __init__(self, export, index, channels, *, workers=PARSE_WORKERS, ahead=PARSE_AHEAD, since=None,
+                 stats=None, profile_dir=None, **kwargs):
+        if workers:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_parse_worker,
+                initargs=(export.path, index),
+            )
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                1, initializer=_init_parse_worker, initargs=(export.path, index)
+            )
+        self._spool_dir = tempfile.TemporaryDirectory(prefix="slack-to-discord-")
+        self._index = index
+        self._stats = stats
+        kwargs.update(stats=stats is not None, profile_dir=profile_dir)
+        self._slots = asyncio.Semaphore(max(1, ahead))
+        self._submitted = {c: asyncio.get_event_loop().create_future() for c, _ in channels}
+        self._producer = asyncio.ensure_future(self._produce(channels, since or {}, kwargs))
+
+    async def _produce(self, channels, since, kwargs):
+        loop = asyncio.get_event_loop()
+        for c, pins in channels:
+            await self._slots.acquire()
+            self._submitted[c].set_result(
+                loop.run_in_executor(self._executor, functools.partial(
+                    _parse_channel_in_worker, self._spool_dir.name, c, pins,
+                    since=since.get(c), bots=dict(self._index.bots), **kwargs
+                ))
+            )
 
-            init_topic = emoji_replace(init_topic, emoji_map)
-            ch = None
+    async def messages(self, channel_name):
+        """Get an iterator of the parsed messages of a channel, waiting for it to be parsed"""
+        path, sends, stats, bots = await (await self._submitted[channel_name])
+        if self._stats is not None:
+            self._stats.merge(stats)
+            self._stats.planned(channel_name, sends)
+        self._index.merge_bots(bots)
+        return _read_parsed(path, self._index)
+
+    def done(self, channel_name):
+        """Mark a channel as sent, letting the next one be parsed"""
+        self._submitted.pop(channel_name)
+        self._slots.release()
+
+    async def close(self):
+        self._producer.cancel()
+        for fut in self._submitted.values():
+            if fut.done():
+                fut.result().cancel()
+        await asyncio.gather(self._producer, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+        self._spool_dir.cleanup()
+
+
+# The counts of a channel's import plan (see plan_channel), in the order they're shown
+PLAN_COUNTS = [
+    "messages", "sends", "separators", "chunks", "uploads", "upload_bytes", "oversized", "threads", "pins", "topics",
+    "edits"
+]
+
+
+def plan_channel(export, index, channel_name, topic, pins, start=None, end=None, pack=False,
+                 filesize_limit=FILESIZE_LIMIT):
+    """Count what importing a channel would do, without doing any of it
+
+    This follows what MyClient does for every message: the Discord messages
+    it sends (including date separators, the extra chunks of long messages
+    and file uploads), the threads it creates and the pins and topic edits
+    it makes. Topic changes are counted as they happen, but only the topic
+    the channel ends up with is set (in one edit). Uploads are counted by
+    the size Slack gives for the files, and the ones over `filesize_limit`
+    (that will use a thumbnail instead) are counted as oversized. Returns a
+    Counter of PLAN_COUNTS and a list of the number of sends to each thread.
+    """
+    counts = collections.Counter()
+    thread_sends = []
+    prev_date = None
+    topic = final_topic = emoji_replace(topic, index.emoji_map)
+
+    def count_msg(msg, is_reply):
+        counts["messages"] += message_count(msg)
+        if len(msg.text) > MAX_MESSAGE_SIZE and not msg.packed:
+            counts["chunks"] += len(split_message(msg.text)) - 1
+        plan = list(make_discord_msgs(msg, is_reply))
+        counts["sends"] += len(plan)
+        for data in plan:
+            fd = data.get("file_data")
+            if fd is None:
+                continue
+            if fd["size"] is not None and fd["size"] > filesize_limit:
+                counts["oversized"] += 1
+            else:
+                counts["uploads"] += 1
+                counts["upload_bytes"] += fd["size"] or 0
+        if plan and msg.events.get("pin"):
+            counts["pins"] += 1
+        return len(plan)
+
+    for msg in channel_messages(export, index, channel_name, pins, start=start, end=end, pack=pack):
+        if DATE_SEPARATOR and msg.date != prev_date:
+            counts["separators"] += 1
+            prev_date = msg.date
+        new_topic = msg.events.get("topic")
+        if new_topic is not None and new_topic != final_topic:
+            counts["topics"] += 1
+            final_topic = new_topic
+        if not count_msg(msg, False):
+            continue
+        if msg.replies:
+            counts["threads"] += 1
+            thread_sends.append(sum(count_msg(x, True) for x in msg.replies))
+    if counts["messages"] and final_topic != topic:
+        counts["edits"] += 1
+    return counts, thread_sends
+
+
+def _plan_channel_in_worker(*args, **kwargs):
+    return plan_channel(_parse_worker.export, _parse_worker.index, *args, **kwargs)
+
+
+def estimate_import_time(counts, thread_sends, rate_limits=RATE_LIMITS, latency=0.25, upload_speed=None,
+                         thread_concurrency=THREAD_CONCURRENCY):
+    """Estimate how long (in seconds) importing a channel would take given its plan
+
+    Requests to Discord are made one at a time, each taking `latency`
+    seconds, and hold up on the channel's (or thread's) rate limits once
+    they're used up. The replies in threads are sent alongside the channel,
+    `thread_concurrency` threads at a time, and so are the pins. The topic
+    is set once the messages are sent. Uploads take extra time at
+    `upload_speed` (bytes per second) if given.
+    """
+    def take(n, route):
+        limit, per = rate_limits[route]
+        return max(n * latency, (n - limit) * per / limit)
+
+    total = take(counts["sends"] - sum(thread_sends) + counts["separators"], "send")
+    total += take(counts["threads"], "thread")
+    replies = [take(n, "send") for n in thread_sends]
+    if replies:
+        total = max(total, sum(replies) / max(1, thread_concurrency), max(replies))
+    total = max(total, take(counts["pins"], "pin")) + take(counts["edits"], "edit")
+    if counts["messages"]:
+        total += latency  # creating the channel
+    if upload_speed:
+        total += counts["upload_bytes"] / upload_speed
+    return total
+
+
+def plan_requests(counts):
+    """The number of requests to Discord in a plan"""
+    return sum(counts[x] for x in ("sends", "separators", "threads", "pins", "edits")) + bool(counts["messages"])
+
+
+def format_plan(rows):
+    """Make a table of plans (rows of name, counts and estimated seconds)"""
+    table = [["channel"] + PLAN_COUNTS + ["time"]]
+    for name, counts, seconds in rows:
+        table.append(
+            [name] +
+            ["{:.1f}M".format(counts[x] / (1024 * 1024)) if x == "upload_bytes" else str(counts[x]) for x in PLAN_COUNTS] +
+            [str(timedelta(seconds=round(seconds)))]
+        )
+    widths = [max(len(r[i]) for r in table) for i in range(len(table[0]))]
+    return "\n".join(
+        "  ".join(x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(r, widths)))
+        for r in table
+    )
 
-            print("Processing channel {}...".format(c))
-            print("Sending messages...")
 
-            for msg in slack_channel_messages(self._data_dir, c, emoji_map, pins):
-                # skip messages that are too early, stop when messages are too late
-                if self._end and msg["datetime"].date() > self._end:
-                    break
-                elif self._start and msg["datetime"].date() < self._start:
-                    continue
+def plan_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="slack-to-discord plan",
+        description="Show what importing a Slack export into Discord would do and estimate how long it would take",
+    )
+    parser.add_argument("-z", "--zipfile", help="The Slack export zip file (or a directory it was extracted to, or a compiled export)", required=True)
+    parser.add_argument("-s", "--start", help="The date to start importing from", required=False, default=None)
+    parser.add_argument("-e", "--end", help="The date to end importing at", required=False, default=None)
+    parser.add_argument("-c", "--concurrency", help="Number of channels to import at the same time (default: %(default)s)", type=int, default=IMPORT_CONCURRENCY)
+    parser.add_argument("--pack", help="Merge consecutive short messages into single Discord messages to send fewer of them", action="store_true", default=False)
+    parser.add_argument("--thread-concurrency", help="Number of threads to post replies to at the same time (default: %(default)s)", type=int, default=THREAD_CONCURRENCY)
+    parser.add_argument("--parse-workers", help="Number of processes parsing channels, 0 to parse them here (default: %(default)s)", type=int, default=PARSE_WORKERS)
+    parser.add_argument("--filesize-limit", help="Max MiB of an upload to Discord (default: %(default)s)", type=float, default=FILESIZE_LIMIT / (1024 * 1024))
+    parser.add_argument("--latency", help="Seconds each request to Discord takes (default: %(default)s)", type=float, default=0.25)
+    parser.add_argument("--upload-speed", help="MiB/s uploads to Discord go at (default: don't count upload time)", type=float, default=None)
+    parser.add_argument("--rate-limit", help="Override a rate limit, as ROUTE=REQUESTS/SECONDS (routes: {})".format(", ".join(RATE_LIMITS)), action="append", default=[])
+    args = parser.parse_args(argv)
+
+    rate_limits = dict(RATE_LIMITS)
+    for x in args.rate_limit:
+        m = re.fullmatch(r"(\w+)=(\d+)/(\d+(?:\.\d*)?)", x)
+        if not m or m.group(1) not in rate_limits or not int(m.group(2)):
+            parser.error("Invalid rate limit: {}".format(x))
+        rate_limits[m.group(1)] = (int(m.group(2)), float(m.group(3)))
+    start, end = [datetime.strptime(x, DATE_FORMAT).date() if x else None for x in (args.start, args.end)]
+    filesize_limit = int(args.filesize_limit * 1024 * 1024)
+    upload_speed = args.upload_speed * 1024 * 1024 if args.upload_speed else None
+
+    with open_export(args.zipfile) as export:
+        index = WorkspaceIndex.from_export(export)
+        channels = slack_channels(export)
+        kwargs = dict(start=start, end=end, pack=args.pack, filesize_limit=filesize_limit)
+        if args.parse_workers:
+            with concurrent.futures.ProcessPoolExecutor(
+                args.parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_parse_worker,
+                initargs=(export.path, index),
+            ) as executor:
+                futures = [
+                    executor.submit(_plan_channel_in_worker, c, topic, pins, **kwargs)
+                    for c, (topic, _, pins) in channels.items()
+                ]
+                plans = [f.result() for f in futures]
+        else:
+            plans = [
+                plan_channel(export, index, c, topic, pins, **kwargs)
+                for c, (topic, _, pins) in channels.items()
+            ]
+
+    rows = []
+    workers = [0.0] * max(1, args.concurrency)
+    totals = collections.Counter()
+    for c, (counts, thread_sends) in zip(channels, plans):
+        if not counts["messages"]:
+            continue
+        seconds = estimate_import_time(counts, thread_sends, rate_limits, args.latency, upload_speed, args.thread_concurrency)
+        rows.append((c, counts, seconds))
+        totals.update(counts)
+        # Channels are taken in order by the first worker to be free
+        workers[workers.index(min(workers))] += seconds
+
+    global_limit, global_per = rate_limits["global"]
+    wall_time = max(max(workers), plan_requests(totals) * global_per / global_limit)
+    rows.append(("total", totals, wall_time))
+    print(format_plan(rows))
+    print("{} requests to Discord, taking about {} with {} channel(s) at a time".format(
+        plan_requests(totals), timedelta(seconds=round(wall_time)), args.concurrency
+    ))
+    if totals["topics"]:
+        print("{} topic changes are coalesced into {} edit(s) (only the final topic of each channel is set)".format(
+            totals["topics"], totals["edits"]
+        ))
+
+
+def compile_export(export, path):
+    """Parse every channel of an export into an indexed SQLite database at `path`
+
+    The messages are stored as they're parsed (with their text converted and
+    their replies, the files, reactions and events as JSON) but not split up
+    into the Discord messages to send, since that depends on the options of
+    each import. They're keyed by channel and `ts`, with the `ts` of the
+    message starting their thread (root) and the date they're from, so a
+    channel or date range can be read without going through the rest. The
+    workspace files are copied as they are and the day files listed with
+    their sizes. Custom emojis aren't known until importing, so those are
+    converted when reading (see `CompiledExport.messages`). The same goes
+    for the names of bots in mentions, so the bot of each message from one
+    is stored with it. Returns the number of messages stored.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    try:
+        db.executescript("""
+            PRAGMA journal_mode=OFF;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE members (name TEXT PRIMARY KEY, channel TEXT, size INTEGER NOT NULL, data BLOB);
+            CREATE TABLE messages (
+                channel TEXT, ts TEXT, root TEXT NOT NULL, day TEXT NOT NULL,
+                username TEXT NOT NULL, text TEXT NOT NULL, reactions TEXT, files TEXT, events TEXT,
+                bot TEXT, bot_name TEXT,
+                PRIMARY KEY (channel, ts)
+            );
+        """)
+        for name in ("users.json", "channels.json"):
+            with export.open(name) as fp:
+                data = fp.read()
+            db.execute("INSERT INTO members VALUES (?, NULL, ?, ?)", (name, len(data), data))
+
+        index = WorkspaceIndex.from_export(export)
+        channels = slack_channels(export)
+        count = 0
+        for i, (c, (_, _, pins)) in enumerate(channels.items(), 1):
+            db.executemany(
+                "INSERT INTO members VALUES (?, ?, ?, NULL)", ((x, c, export.size(x)) for x in export.channel_files(c))
+            )
+            index.found_bots = {}
+            index.bot_messages = {}
+            for msg in slack_channel_messages(export, c, index, pins):
+                rows = [msg, *msg.replies]
+                db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                    (
+                        c, x.ts, msg.ts, x.datetime.date().isoformat(), x.username, x.text,
+                        *(json.dumps(y) if y else None for y in (x.reactions, x.files, x.events)),
+                        *index.bot_messages.get(x.ts, (None, None)),
+                    )
+                    for x in rows
+                ))
+                count += len(rows)
+            print("Compiled channel {} ({}/{} channels)".format(c, i, len(channels)))
+
+        db.executescript("""
+            CREATE INDEX messages_root ON messages (channel, root, ts);
+            CREATE INDEX messages_day ON messages (channel, day);
+        """)
+        db.execute("INSERT INTO meta VALUES ('version', ?)", (str(COMPILED_VERSION),))
+        db.execute("INSERT INTO meta VALUES ('source', ?)", (os.path.abspath(export.path),))
+        db.commit()
+    except BaseException:
+        db.close()
+        os.remove(path)
+        raise
+    db.close()
+    return count
+
+
+def compile_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="slack-to-discord compile",
+        description="Parse a Slack export ahead of time into a file that can be imported (and planned) from quickly",
+    )
+    parser.add_argument("-z", "--zipfile", help="The Slack export zip file (or a directory it was extracted to)", required=True)
+    parser.add_argument("-o", "--output", help="Where to write the compiled export (default: next to the export)", default=None)
+    args = parser.parse_args(argv)
 
-                # Now that we have a message to send, get/create the channel to send it to
-                if ch is None:
-                    if c not in existing_channels:
-                        if self._all_private or is_private:
-                            print("Creating private channel")
-                            overwrites = {
-                                g.default_role: discord.PermissionOverwrite(read_messages=False),
-                                g.me: discord.PermissionOverwrite(read_messages=True),
-                            }
-                            ch = await g.create_text_channel(c, topic=init_topic, overwrites=overwrites)
-                        else:
-                            print("Creating public channel")
-                            ch = await g.create_text_channel(c, topic=init_topic)
-                    else:
-                        ch = existing_channels[c]
-                    c_chan += 1
-
-                topic = msg["events"].get("topic", None)
-                if topic is not None and topic != ch.topic:
-                    # Note that the ratelimit is pretty extreme for this
-                    # (2 edits per 10 minutes) so it may take a while if there
-                    # a lot of topic changes
-                    await ch.edit(topic=topic)
-
-                # Send message and threaded replies
-                message_obj = await self._send_slack_msg(ch, msg)
-                c_msg += 1
-                if len(msg["replies"]) and message_obj is not None:
-                    tname = " ".join(msg["text"].split()[:THREAD_NAME_MAX_NWORDS])[:THREAD_NAME_MAX_NSYMBOLS]
-                    tname = tname if len(tname) else "Thread"  # if thread created for image-message that absent text discord.py cannot create thread
-                    thrd = await message_obj.create_thread(name=tname)
-                    for rmsg in msg["replies"]:
-                        await self._send_slack_msg(ch, rmsg, thread=thrd)
-                        c_msg += 1
-            print("Done!")
-        print("Imported {} messages into {} channel(s) in {}".format(c_msg, c_chan, datetime.now()-start_time))
+    path = args.output or "{}.compiled.sqlite".format(args.zipfile.rstrip("/\\"))
+    start_time = datetime.now()
+    with SlackExport(args.zipfile) as export:
+        count = compile_export(export, path)
+    print("Compiled {} messages into {} in {}".format(count, path, datetime.now() - start_time))
+    print("Import it (or plan an import of it) by giving it as the --zipfile")
 
 
 def main():
+    if sys.argv[1:2] == ["plan"]:
+        return plan_main(sys.argv[2:])
+    if sys.argv[1:2] == ["compile"]:
+        return compile_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
-        description="Import Slack chat history into Discord"
+        description="Import Slack chat history into Discord (or run `%(prog)s plan` to see what that would do first, "
+                    "or `%(prog)s compile` to parse the export ahead of time)"
     )
-    parser.add_argument("-z", "--zipfile", help="The Slack export zip file", required=True)
+    parser.add_argument("-z", "--zipfile", help="The Slack export zip file (or a directory it was extracted to, or a compiled export)", required=True)
     parser.add_argument("-g", "--guild", help="The Discord Guild to import history into", required=True)
-    parser.add_argument("-t", "--token", help="The Discord bot token", required=True)
+    parser.add_argument("-t", "--token", help="The Discord bot token (not needed for a dry run), can be given more than once to share the import between several bots", action="append", default=[])
     parser.add_argument("-s", "--start", help="The date to start importing from", required=False, default=None)
     parser.add_argument("-e", "--end", help="The date to end importing at", required=False, default=None)
     parser.add_argument("-p", "--all-private", help="Import all channels as private channels in Discord", action="store_true", default=False)
     parser.add_argument("-x", "--skip-existing", help="Skip channel if guild already contain channel with same name", action="store_true", default=False)
+    parser.add_argument("-r", "--resume", help="Resume an interrupted import, skipping everything it already posted", action="store_true", default=False)
+    parser.add_argument("--delta", help="Only import what's new since the last import (from a newer export), into the channels and threads it made", action="store_true", default=False)
+    parser.add_argument("--journal", help="Where to record the import progress (default: next to the export)", default=None)
+    parser.add_argument("-c", "--concurrency", help="Number of channels to import at the same time (default: %(default)s)", type=int, default=IMPORT_CONCURRENCY)
+    parser.add_argument("--thread-concurrency", help="Number of threads to post replies to at the same time as their channels (default: %(default)s)", type=int, default=THREAD_CONCURRENCY)
+    parser.add_argument("--pack", help="Merge consecutive short messages into single Discord messages to send fewer of them", action="store_true", default=False)
+    parser.add_argument("--parse-workers", help="Number of processes parsing channels ahead of sending them, 0 to use a thread (default: %(default)s)", type=int, default=PARSE_WORKERS)
+    parser.add_argument("--download-workers", help="Number of attachments to download concurrently (default: %(default)s)", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--download-memory", help="Max MiB of attachments to download ahead of sending them (default: %(default)s)", type=int, default=DOWNLOAD_MEMORY_BUDGET // (1024 * 1024))
+    parser.add_argument("--attachment-cache", help="Where to keep downloaded attachments between imports (default: next to the export)", default=None)
+    parser.add_argument("--attachment-cache-size", help="Max MiB of attachments to keep, 0 to not keep any (default: %(default)s)", type=int, default=ATTACHMENT_CACHE_SIZE // (1024 * 1024))
+    parser.add_argument("--webhooks", help="Post messages through this many webhooks per channel, named after the Slack users, instead of as the bot", type=int, default=0)
+    parser.add_argument("--dry-run", help="Go through the whole import without connecting to Discord, then show the calls it would have made", action="store_true", default=False)
+    parser.add_argument("--dry-run-speed", help="Simulate Discord's rate limits in a dry run, with time running this many times faster", type=float, default=None)
+    parser.add_argument("--stats", help="Write the timings and progress of the import to this file as it goes, as JSON lines (or Prometheus text if it ends in .prom)", default=None)
+    parser.add_argument("--stats-interval", help="Seconds between showing the progress and writing the stats (default: %(default)s)", type=float, default=STATS_INTERVAL)
+    parser.add_argument("--profile-parse", help="Profile parsing each channel with cProfile, saving the profiles to this directory", default=None)
 
     args = parser.parse_args()
+    from slack_to_discord_client import (
+        AttachmentCache, BotTransport, DryRunGuild, ImportCoordinator, ImportJournal, MyClient, WebhookTransport,
+        log_rate_limits,
+    )
 
-    print("Extracting zipfile...", end="", flush=True)
-    with tempfile.TemporaryDirectory() as t:
-        with zipfile.ZipFile(args.zipfile, 'r') as z:
-            z.extractall(t)
-        print("Done!")
-
-        print("Logging the bot into Discord...", end="", flush=True)
-        client = MyClient(
-            data_dir=t,
-            guild_name=args.guild,
-            all_private=args.all_private,
-            skip_existing_channel=args.skip_existing
-            start=args.start,
-            end=args.end
-        )
-        client.run(args.token)
+    if not args.token and not args.dry_run:
+        parser.error("the following arguments are required: -t/--token")
+
+    journal_path = args.journal or "{}.journal.sqlite".format(args.zipfile.rstrip("/\\"))
+    if args.dry_run:
+        if args.resume or args.delta:
+            parser.error("A dry run can't be resumed or a delta import")
+        if args.webhooks:
+            parser.error("A dry run can't use webhooks")
+        # Don't touch the journal of a real import
+        journal_path = ":memory:"
+    elif (args.resume or args.delta) and not os.path.exists(journal_path):
+        parser.error("No journal to resume from at {}".format(journal_path))
+
+    cache_path = args.attachment_cache or "{}.cache".format(args.zipfile.rstrip("/\\"))
+    if args.profile_parse:
+        os.makedirs(args.profile_parse, exist_ok=True)
+
+    with open_export(args.zipfile) as export, contextlib.closing(ImportJournal(journal_path, resume=args.resume or args.delta)) as journal, \
+            contextlib.ExitStack() as stack:
+        # Downloads are shared by all the bots (and kept for the next import)
+        cache = None
+        if args.attachment_cache_size > 0:
+            cache = stack.enter_context(contextlib.closing(
+                AttachmentCache(cache_path, args.attachment_cache_size * 1024 * 1024)
+            ))
+
+        # All the bots add to the same stats, including the rate limits discord.py waits out
+        stats = ImportStats()
+        stack.enter_context(log_rate_limits(stats))
+
+        # Each bot (token) imports its share of the channels with its own connection and rate limits
+        bots = max(1, len(args.token))
+        coordinator = ImportCoordinator(export, bots)
+        if not args.dry_run:
+            print("Logging the bot(s) into Discord...", end="", flush=True)
+        clients = [
+            MyClient(
+                export=export,
+                journal=journal,
+                guild_name=args.guild,
+                all_private=args.all_private,
+                skip_existing_channels=args.skip_existing,
+                start=args.start,
+                end=args.end,
+                concurrency=args.concurrency,
+                thread_concurrency=args.thread_concurrency,
+                pack=args.pack,
+                parse_workers=-(-args.parse_workers // bots),
+                download_workers=args.download_workers,
+                download_memory=args.download_memory * 1024 * 1024 // bots,
+                attachment_cache=cache,
+                transport=WebhookTransport(args.webhooks, stats=stats) if args.webhooks > 0 else BotTransport(),
+                coordinator=coordinator,
+                shard=i,
+                delta=args.delta,
+                stats=stats,
+                profile_dir=args.profile_parse,
+            )
+            for i in range(bots)
+        ]
+        loop = clients[0].loop
+        report = loop.create_task(stats.report(args.stats, args.stats_interval))
+        try:
+            if args.dry_run:
+                guild = DryRunGuild(args.guild, time_scale=args.dry_run_speed, stats=stats)
+                loop.run_until_complete(asyncio.gather(*(x.dry_run(guild) for x in clients)))
+                print(guild.summary())
+            else:
+                try:
+                    loop.run_until_complete(asyncio.gather(*(x.start(t) for x, t in zip(clients, args.token))))
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    loop.run_until_complete(asyncio.gather(*(x.close() for x in clients)))
+        finally:
+            report.cancel()
+            loop.run_until_complete(asyncio.gather(report, return_exceptions=True))
+            if args.stats:
+                stats.write(args.stats)
+            print(stats.format())
 
 
 if __name__ == "__main__":
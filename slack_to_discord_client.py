@@ -0,0 +1,1269 @@
+"""The Discord side of an import: downloading attachments and posting messages
+
+This is kept apart from slack_to_discord so parsing and planning an import
+doesn't need discord.py.
+"""
+
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+import aiohttp
+import discord
+from discord.errors import Forbidden
+from discord.channel import TextChannel
+
+from slack_to_discord import (
+    ATTACHMENT_CACHE_SIZE,
+    ATTACHMENT_ERROR_APPEND,
+    DATE_FORMAT,
+    DATE_SEPARATOR,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_LOOKAHEAD,
+    DOWNLOAD_MEMORY_BUDGET,
+    DOWNLOAD_SPOOL_SIZE,
+    DOWNLOAD_WORKERS,
+    FILESIZE_LIMIT,
+    IMPORT_CONCURRENCY,
+    PARSE_AHEAD,
+    PARSE_WORKERS,
+    RATE_LIMITS,
+    THREAD_CONCURRENCY,
+    THREAD_NAME_MAX_NSYMBOLS,
+    THREAD_NAME_MAX_NWORDS,
+    WEBHOOK_NAME,
+    ChannelParser,
+    WorkspaceIndex,
+    emoji_replace,
+    last_ts,
+    message_count,
+    slack_channels,
+)
+
+
+class AttachmentCache:
+    """Downloaded attachments kept on disk, shared between channels, bots and imports
+
+    Files are stored under the SHA-256 of their contents (so a file shared
+    in several channels is only stored once) and indexed by Slack file ID
+    and URL in an SQLite database next to them. Once the files take up more
+    than `max_size` bytes, the least recently used ones are removed.
+
+    What happened to each file is remembered too: the size of each URL (as
+    downloaded or probed), the URLs that failed in a way that retrying
+    won't fix (a 4xx response), and which candidate (the original or one of
+    the thumbnails) was accepted for a given upload limit, so the ones
+    before it don't have to be tried again.
+    """
+
+    def __init__(self, path, max_size=ATTACHMENT_CACHE_SIZE):
+        self._path = path
+        self._max_size = max_size
+        os.makedirs(os.path.join(path, "files"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                file_id TEXT, url TEXT, size INTEGER, sha256 TEXT, failed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (file_id, url)
+            );
+            CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS accepted (
+                file_id TEXT, size_limit INTEGER, url TEXT NOT NULL,
+                PRIMARY KEY (file_id, size_limit)
+            );
+        """)
+        self._size = self._get("SELECT SUM(size) FROM blobs") or 0
+
+    def _get(self, query, *args):
+        row = self._db.execute(query, args).fetchone()
+        return row[0] if row else None
+
+    def _update(self, file_id, url, column, value):
+        self._db.execute(
+            "INSERT INTO urls (file_id, url, {0}) VALUES (?, ?, ?) "
+            "ON CONFLICT (file_id, url) DO UPDATE SET {0} = excluded.{0}".format(column),
+            (file_id or "", url, value)
+        )
+
+    def _blob_path(self, sha256):
+        return os.path.join(self._path, "files", sha256)
+
+    def size(self, file_id, url):
+        """The size of a URL, if known"""
+        return self._get("SELECT size FROM urls WHERE file_id = ? AND url = ?", file_id or "", url)
+
+    def record_size(self, file_id, url, size):
+        self._update(file_id, url, "size", size)
+
+    def failed(self, file_id, url):
+        """If downloading a URL failed for good"""
+        return bool(self._get("SELECT failed FROM urls WHERE file_id = ? AND url = ?", file_id or "", url))
+
+    def record_failure(self, file_id, url):
+        self._update(file_id, url, "failed", 1)
+
+    def accepted(self, file_id, size_limit):
+        """The URL of the candidate of a file that was accepted for an upload limit (None if not known)"""
+        return self._get(
+            "SELECT url FROM accepted WHERE file_id = ? AND size_limit IS ?", file_id or "", size_limit
+        )
+
+    def record_accepted(self, file_id, size_limit, url):
+        self._db.execute("INSERT OR REPLACE INTO accepted VALUES (?, ?, ?)", (file_id or "", size_limit, url))
+
+    def open(self, file_id, url):
+        """Get a file object with the cached contents of a URL and its size (None if not cached)
+
+        The caller takes ownership of the returned file and must close it.
+        """
+        row = self._db.execute(
+            "SELECT blobs.sha256, blobs.size FROM urls JOIN blobs USING (sha256) WHERE file_id = ? AND url = ?",
+            (file_id or "", url)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            fp = open(self._blob_path(row[0]), "rb")
+        except FileNotFoundError:
+            self._remove(row[0])
+            return None
+        self._db.execute("UPDATE blobs SET used = ? WHERE sha256 = ?", (time.time(), row[0]))
+        return fp, row[1]
+
+    def store(self, file_id, url, fp, size, sha256):
+        """Keep a copy of the contents of a URL (a file object positioned at its end)"""
+        if size > self._max_size:
+            return
+        if self._get("SELECT 1 FROM blobs WHERE sha256 = ?", sha256) is None:
+            fp.seek(0)
+            with tempfile.NamedTemporaryFile(dir=os.path.join(self._path, "files"), delete=False) as f:
+                while True:
+                    chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(f.name, self._blob_path(sha256))
+            self._db.execute("INSERT INTO blobs VALUES (?, ?, ?)", (sha256, size, time.time()))
+            self._size += size
+        else:
+            self._db.execute("UPDATE blobs SET used = ? WHERE sha256 = ?", (time.time(), sha256))
+        self._update(file_id, url, "sha256", sha256)
+        self.record_size(file_id, url, size)
+
+        # Make room by removing the least recently used files
+        while self._size > self._max_size:
+            oldest = self._get("SELECT sha256 FROM blobs WHERE sha256 != ? ORDER BY used LIMIT 1", sha256)
+            if oldest is None:
+                break
+            self._remove(oldest)
+
+    def _remove(self, sha256):
+        self._size -= self._get("SELECT size FROM blobs WHERE sha256 = ?", sha256) or 0
+        self._db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        self._db.execute("UPDATE urls SET sha256 = NULL WHERE sha256 = ?", (sha256,))
+        # Files that are open (being sent) can't be removed on Windows
+        with contextlib.suppress(OSError):
+            os.remove(self._blob_path(sha256))
+
+    def close(self):
+        self._db.close()
+
+
+class AttachmentFetcher:
+    """Downloads attachments in the background, ahead of the messages that need them
+
+    Files passed to `prefetch` are handled by up to `workers` concurrent
+    requests, in the order they were requested. For each one, the best
+    candidate (the original, then the thumbnails) that fits in `size_limit`
+    is picked using the size Slack reports or a HEAD request, and only that
+    candidate is downloaded. No new downloads are started while
+    `memory_budget` bytes are held; they resume as `fetch` or `release` frees
+    them. `fetch` waits for a download that is in flight or done (or starts
+    it immediately if it isn't) so the sender never blocks the event loop.
+
+    With a `cache` (see AttachmentCache), files are read from it instead of
+    being downloaded again, and candidates that failed for good or come
+    before the one that was accepted last time aren't tried.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, memory_budget=DOWNLOAD_MEMORY_BUDGET, size_limit=None, cache=None,
+                 stats=None):
+        self.size_limit = size_limit
+        self._cache = cache
+        self._stats = stats
+        self._session = aiohttp.ClientSession()
+        self._workers = workers
+        self._budget = memory_budget
+        self._active = 0
+        self._held = 0
+        self._pending = collections.deque()
+        self._prefetching = {}
+        self._tasks = {}
+        self._downloading = {}
+        self._sizes = {}
+
+    def prefetch(self, files):
+        for fd in files:
+            if fd["url"] not in self._prefetching and fd not in self._pending:
+                self._pending.append(fd)
+        self._pump()
+
+    async def candidates(self, fd):
+        """Yield the (url, filename) of each candidate for a file that might fit in the upload limit"""
+        urls = [fd["url"]] + fd.get("thumbs", [])
+        first = 0
+        if self._cache is not None:
+            accepted = self._cache.accepted(fd.get("id"), self.size_limit)
+            if accepted in urls:
+                first = urls.index(accepted)
+
+        for i, url in enumerate(urls):
+            if i < first or (self._cache is not None and self._cache.failed(fd.get("id"), url)):
+                continue
+            if i > 0:
+                # Thumbnails - get the filename from Slack (it has the correct extension)
+                filename = urlparse(url).path.rsplit("/", 1)[-1]
+            else:
+                filename = fd["name"]
+
+            if self.size_limit is not None:
+                size = fd.get("size") if i == 0 else None
+                if size is None:
+                    size = await self._probe(url, fd.get("id"))
+                if size is not None and size > self.size_limit:
+                    continue
+            yield url, filename
+
+    async def fetch(self, url, file_id=None):
+        """Get a file object with the contents of a URL, raising if the download failed
+
+        The caller takes ownership of the returned file and must close it.
+        """
+        task = self._tasks.pop(url, None) or asyncio.ensure_future(self._download(url, file_id))
+        fp, size = await task
+        self._held -= size
+        self._pump()
+        return fp
+
+    def accept(self, fd, url):
+        """Record the candidate of a file that was uploaded"""
+        if self._cache is not None:
+            self._cache.record_accepted(fd.get("id"), self.size_limit, url)
+
+    def release(self, files):
+        """Forget about prefetched files that are no longer needed, freeing their data"""
+        for fd in files:
+            with contextlib.suppress(ValueError):
+                self._pending.remove(fd)
+            prefetch = self._prefetching.pop(fd["url"], None)
+            if prefetch is not None and not prefetch.done():
+                prefetch.cancel()
+            for url in [fd["url"]] + fd.get("thumbs", []):
+                self._discard(self._tasks.pop(url, None))
+        self._pump()
+
+    async def close(self):
+        self._pending.clear()
+        for task in self._prefetching.values():
+            task.cancel()
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._prefetching.values(), *self._tasks.values(), return_exceptions=True)
+        for task in self._tasks.values():
+            self._discard(task)
+        self._prefetching.clear()
+        self._tasks.clear()
+        await self._session.close()
+
+    def _discard(self, task):
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            fp, size = task.result()
+            fp.close()
+            self._held -= size
+
+    def _pump(self):
+        while self._pending and self._active < self._workers and self._held < self._budget:
+            fd = self._pending.popleft()
+            self._active += 1
+            self._prefetching[fd["url"]] = asyncio.ensure_future(self._prefetch(fd))
+
+    async def _prefetch(self, fd):
+        try:
+            async for url, _ in self.candidates(fd):
+                if url not in self._tasks:
+                    self._tasks[url] = asyncio.ensure_future(self._download(url, fd.get("id")))
+                # Hold on to the worker until the download is done
+                await asyncio.wait([self._tasks[url]])
+                return
+        finally:
+            self._active -= 1
+            self._pump()
+
+    async def _probe(self, url, file_id=None):
+        """Get the size of a URL without downloading it (None if unknown)"""
+        if url not in self._sizes:
+            size = self._cache.size(file_id, url) if self._cache is not None else None
+            if size is None:
+                with contextlib.suppress(Exception):
+                    async with self._session.head(url, allow_redirects=True, raise_for_status=True) as resp:
+                        size = resp.content_length
+                if size is not None and self._cache is not None:
+                    self._cache.record_size(file_id, url, size)
+            self._sizes[url] = size
+        return self._sizes[url]
+
+    async def _download(self, url, file_id=None):
+        if self._cache is not None:
+            # Let a download of the same URL that's already going finish, then use its copy
+            while url in self._downloading:
+                await asyncio.wait([self._downloading[url]])
+            cached = self._cache.open(file_id, url)
+            if cached is not None:
+                if self._stats is not None:
+                    self._stats.count("cache_hit")
+                # Read from disk as it's sent, so it doesn't count against the memory budget
+                fp, self._sizes[url] = cached
+                return fp, 0
+            task = self._downloading[url] = asyncio.current_task()
+            task.add_done_callback(lambda _: self._downloading.pop(url, None))
+
+        # Small files stay in memory, bigger ones are spooled to disk
+        # (tempfile.SpooledTemporaryFile isn't an io.IOBase before Python 3.11
+        # so discord.File would mistake it for a path)
+        fp = io.BytesIO()
+        size = 0
+        sha256 = hashlib.sha256()
+        t = time.perf_counter()
+        try:
+            try:
+                async with self._session.get(url, raise_for_status=True) as resp:
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > DOWNLOAD_SPOOL_SIZE and isinstance(fp, io.BytesIO):
+                            spooled = tempfile.TemporaryFile()
+                            spooled.write(fp.getbuffer())
+                            fp = spooled
+                        fp.write(chunk)
+                        sha256.update(chunk)
+            except aiohttp.ClientResponseError as e:
+                # Retrying won't help with these
+                if self._cache is not None and 400 <= e.status < 500 and e.status not in (408, 429):
+                    self._cache.record_failure(file_id, url)
+                raise
+            if self._stats is not None:
+                self._stats.observe("download", time.perf_counter() - t)
+            if self._cache is not None:
+                self._cache.store(file_id, url, fp, size, sha256.hexdigest())
+        except BaseException as e:
+            fp.close()
+            if self._stats is not None and isinstance(e, Exception):
+                self._stats.count("download_failed")
+            raise
+        fp.seek(0)
+        self._sizes[url] = size
+        self._held += size
+        return fp, size
+
+
+async def aenumerate(iterable):
+    i = 0
+    async for x in iterable:
+        yield i, x
+        i += 1
+
+
+async def prefetch_messages(messages, fetcher, lookahead=DOWNLOAD_LOOKAHEAD):
+    """Yield messages while queueing the attachments of the next `lookahead` ones for download"""
+    window = collections.deque()
+    for msg in messages:
+        for m in (msg, *msg.replies):
+            fetcher.prefetch(m.files)
+        window.append(msg)
+        if len(window) > lookahead:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+
+async def file_upload_attempts(data, fetcher):
+    # Files that are too big cause issues
+    # yield data to try to send (the best candidates that fit, original first)
+    if data.get("embed") is not None:
+        data["embed"] = discord.Embed.from_dict(data["embed"])
+    fd = data.pop("file_data", None)
+    if not fd:
+        yield data
+        return
+
+    thumb_used = False
+    async for url, filename in fetcher.candidates(fd):
+        if url != fd["url"] and not thumb_used:
+            # The original is too big or failed - using thumbnails
+            thumb_used = True
+            data["content"] += ATTACHMENT_ERROR_APPEND.format(**fd)
+
+        try:
+            fp = await fetcher.fetch(url, fd.get("id"))
+        except Exception:
+            continue
+
+        try:
+            yield {
+                **data,
+                "file": discord.File(fp=fp, filename=filename)
+            }
+        except GeneratorExit:
+            # Stopped trying once this one was sent (see MyClient._send_slack_msg)
+            fetcher.accept(fd, url)
+            raise
+        finally:
+            fp.close()
+
+    if not thumb_used:
+        data["content"] += ATTACHMENT_ERROR_APPEND.format(**fd)
+
+    print("Failed to upload file for message '{}'".format(data["content"]))
+
+    # Just post the message without the attachment
+    yield data
+
+
+class BotTransport:
+    """Posts messages as the bot, with the Slack usernames in their text"""
+
+    show_usernames = True
+
+    async def send(self, channel, data, username=None, thread=None):
+        """Post a message (to a thread of the channel if given), returning it"""
+        return await (thread or channel).send(**data)
+
+    async def close(self):
+        pass
+
+
+def webhook_username(name):
+    """Make a name that Discord will accept for a webhook message"""
+    # "clyde" and "discord" aren't allowed in names
+    name = re.sub(r"(?i)(clyd)(e)|(discor)(d)", "\\1\\3\u200b\\2\\4", name)
+    return name[:80] or "[unknown]"
+
+
+class Webhook:
+    """A webhook that messages can be posted through, waiting out its rate limits"""
+
+    def __init__(self, url):
+        self.url = url
+        self.ready_at = 0.0
+
+    async def execute(self, session, data, username=None, thread_id=None, stats=None):
+        """Post a message, returning its ID (adding its rate limit waits to `stats` if given)"""
+        loop = asyncio.get_event_loop()
+        params = {"wait": "true"}
+        if thread_id is not None:
+            params["thread_id"] = str(thread_id)
+        payload = {"content": data.get("content") or ""}
+        if username:
+            payload["username"] = webhook_username(username)
+        if data.get("embed") is not None:
+            payload["embeds"] = [data["embed"].to_dict()]
+
+        while True:
+            wait = self.ready_at - loop.time()
+            if wait > 0 and stats is not None:
+                stats.observe("ratelimit", wait)
+            await asyncio.sleep(wait)
+            file = data.get("file")
+            if file is not None:
+                file.reset()
+                body = aiohttp.FormData()
+                body.add_field("payload_json", json.dumps(payload), content_type="application/json")
+                body.add_field("files[0]", file.fp, filename=file.filename)
+                kwargs = {"data": body}
+            else:
+                kwargs = {"json": payload}
+
+            async with session.post(self.url, params=params, **kwargs) as resp:
+                if resp.headers.get("X-RateLimit-Remaining") == "0":
+                    self.ready_at = loop.time() + float(resp.headers.get("X-RateLimit-Reset-After", 1))
+                if resp.status == 429:
+                    self.ready_at = loop.time() + float((await resp.json()).get("retry_after", 1))
+                    if stats is not None:
+                        stats.count("429")
+                    continue
+                resp.raise_for_status()
+                return int((await resp.json())["id"])
+
+
+class WebhookTransport:
+    """Posts messages through pools of webhooks, named after the Slack users
+
+    Webhooks have their own rate limits, separate from the bot's, so each
+    channel's messages are spread over `per_channel` of them (replies go
+    through their channel's webhooks too). The webhooks are made as needed,
+    reusing ones named WEBHOOK_NAME that are already there, which needs the
+    "manage webhooks" permission. `add_webhooks` can be used to give the
+    URLs of a channel's webhooks instead.
+    """
+
+    show_usernames = False
+
+    def __init__(self, per_channel=1, stats=None):
+        self._per_channel = max(1, per_channel)
+        self._stats = stats
+        self._session = aiohttp.ClientSession()
+        self._pools = {}
+
+    def add_webhooks(self, channel_id, urls):
+        self._pools[channel_id] = [Webhook(x) for x in urls]
+
+    async def _pool(self, channel):
+        if channel.id not in self._pools:
+            webhooks = [x for x in await channel.webhooks() if x.name == WEBHOOK_NAME and x.token]
+            while len(webhooks) < self._per_channel:
+                webhooks.append(await channel.create_webhook(name=WEBHOOK_NAME))
+            self.add_webhooks(channel.id, [x.url for x in webhooks[:self._per_channel]])
+        return self._pools[channel.id]
+
+    async def send(self, channel, data, username=None, thread=None):
+        """Post a message (to a thread of the channel if given), returning it"""
+        webhook = min(await self._pool(channel), key=lambda x: x.ready_at)
+        message_id = await webhook.execute(self._session, data, username, thread.id if thread else None, self._stats)
+        return (thread or channel).get_partial_message(message_id)
+
+    async def close(self):
+        await self._session.close()
+
+
+class ImportJournal:
+    """Persistent record of everything posted so far, used to resume an interrupted import
+
+    Every Discord message is recorded against the Slack channel and `ts` it
+    was made from, plus its part: -1 for the date separator in front of it,
+    then one per chunk/file from `make_discord_msgs`. The IDs of created
+    channels and threads are recorded too, as are the messages that have
+    been pinned (pins are made in the background so can be behind the
+    posts). Unless resuming, opening the journal clears it.
+
+    For delta imports, the `ts` of the last message imported to each
+    channel and of the last reply imported to each thread are kept as the
+    channel's mark.
+    """
+
+    def __init__(self, path, resume=False):
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS channels (name TEXT PRIMARY KEY, channel_id INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS threads (
+                channel TEXT, ts TEXT, thread_id INTEGER NOT NULL,
+                PRIMARY KEY (channel, ts)
+            );
+            CREATE TABLE IF NOT EXISTS posts (
+                channel TEXT, ts TEXT, part INTEGER, message_id INTEGER NOT NULL,
+                PRIMARY KEY (channel, ts, part)
+            );
+            CREATE TABLE IF NOT EXISTS marks (
+                channel TEXT, thread TEXT, ts TEXT NOT NULL,
+                PRIMARY KEY (channel, thread)
+            );
+            CREATE TABLE IF NOT EXISTS pins (channel TEXT, ts TEXT, PRIMARY KEY (channel, ts));
+        """)
+        if not resume:
+            self._db.executescript(
+                "DELETE FROM channels; DELETE FROM threads; DELETE FROM posts; DELETE FROM marks; DELETE FROM pins;"
+            )
+
+    def _get(self, query, *args):
+        row = self._db.execute(query, args).fetchone()
+        return row[0] if row else None
+
+    def channel_id(self, name):
+        return self._get("SELECT channel_id FROM channels WHERE name = ?", name)
+
+    def record_channel(self, name, channel_id):
+        self._db.execute("INSERT OR REPLACE INTO channels VALUES (?, ?)", (name, channel_id))
+
+    def thread_id(self, channel, ts):
+        return self._get("SELECT thread_id FROM threads WHERE channel = ? AND ts = ?", channel, ts)
+
+    def record_thread(self, channel, ts, thread_id):
+        self._db.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?)", (channel, ts, thread_id))
+
+    def posted(self, channel, ts, part):
+        """The ID of the Discord message posted for a part of a Slack message (None if not posted)"""
+        return self._get(
+            "SELECT message_id FROM posts WHERE channel = ? AND ts = ? AND part = ?", channel, ts, part
+        )
+
+    def record_post(self, channel, ts, part, message_id):
+        self._db.execute("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)", (channel, ts, part, message_id))
+
+    def pinned(self, channel, ts):
+        return self._get("SELECT 1 FROM pins WHERE channel = ? AND ts = ?", channel, ts) is not None
+
+    def record_pin(self, channel, ts):
+        self._db.execute("INSERT OR REPLACE INTO pins VALUES (?, ?)", (channel, ts))
+
+    def last_post(self, channel, ts):
+        """The ID of the last Discord message posted for a Slack message (None if not posted)"""
+        return self._get(
+            "SELECT message_id FROM posts WHERE channel = ? AND ts = ? ORDER BY part DESC LIMIT 1", channel, ts
+        )
+
+    def mark(self, channel):
+        """The mark of a channel as (last message ts, {thread ts: last reply ts}), None if nothing was imported"""
+        rows = self._db.execute("SELECT thread, ts FROM marks WHERE channel = ?", (channel,)).fetchall()
+        marks = dict(rows)
+        if "" not in marks:
+            return None
+        return marks.pop(""), marks
+
+    def record_mark(self, channel, ts, thread=""):
+        """Move the mark of a channel (or one of its threads) up to a message"""
+        self._db.execute(
+            "INSERT INTO marks VALUES (?, ?, ?) ON CONFLICT (channel, thread) DO UPDATE SET ts = MAX(ts, excluded.ts)",
+            (channel, thread, ts)
+        )
+
+    def close(self):
+        self._db.close()
+
+
+class DryRunGuild:
+    """A stand-in for a Discord guild that records what an import does instead of doing it
+
+    Every call made on it (and on its channels, threads and messages) is
+    counted per channel and, with `record`, logged to `calls` as a tuple of
+    (kind, channel name, details). Uploads are read in full so downloads
+    and upload attempts run like they would for real.
+
+    With a `time_scale`, Discord's rate limits (see RATE_LIMITS) are
+    simulated on a clock running that much faster than real time: calls
+    over a limit are counted (and logged) as a 429 response and then wait
+    for the limit to reset, like discord.py does. The waits are added to
+    `stats` (an ImportStats) if given.
+    """
+
+    filesize_limit = FILESIZE_LIMIT
+
+    def __init__(self, name, *, time_scale=None, record=False, stats=None):
+        self.name = name
+        self.stats = stats
+        self.text_channels = []
+        self.default_role = object()
+        self.me = object()
+        self.calls = [] if record else None
+        self.counts = collections.defaultdict(collections.Counter)
+        self._time_scale = time_scale
+        self._buckets = collections.defaultdict(collections.deque)
+        self._by_id = {}
+        self._ids = itertools.count(1)
+
+    def __repr__(self):
+        return "<DryRunGuild name={!r}>".format(self.name)
+
+    def _new_id(self, obj):
+        obj.id = next(self._ids)
+        self._by_id[obj.id] = obj
+        return obj.id
+
+    async def _call(self, kind, route, channel, details=None):
+        if self._time_scale:
+            await self._rate_limit("global", channel)
+            if route in RATE_LIMITS:
+                await self._rate_limit((route, channel.id), channel)
+        self.counts[channel.name][kind] += 1
+        if self.calls is not None:
+            self.calls.append((kind, channel.name, details))
+
+    async def _rate_limit(self, key, channel):
+        limit, per = RATE_LIMITS[key if key == "global" else key[0]]
+        per /= self._time_scale
+        bucket = self._buckets[key]
+        while True:
+            now = time.monotonic()
+            while bucket and bucket[0] <= now - per:
+                bucket.popleft()
+            if len(bucket) < limit:
+                bucket.append(now)
+                return
+            self.counts[channel.name]["429"] += 1
+            if self.calls is not None:
+                self.calls.append(("429", channel.name, key if key == "global" else key[0]))
+            if self.stats is not None:
+                self.stats.count("429")
+                self.stats.observe("ratelimit", bucket[0] + per - now)
+            await asyncio.sleep(bucket[0] + per - now)
+
+    def get_channel(self, channel_id):
+        channel = self._by_id.get(channel_id)
+        return channel if isinstance(channel, DryRunChannel) else None
+
+    def get_thread(self, thread_id):
+        thread = self._by_id.get(thread_id)
+        return thread if isinstance(thread, DryRunThread) else None
+
+    async def create_text_channel(self, name, *, topic=None, overwrites=None):
+        channel = DryRunChannel(self, name, topic)
+        await self._call("create_channel", "create_channel", channel, "private" if overwrites else "public")
+        self.text_channels.append(channel)
+        return channel
+
+    def summary(self):
+        """A table of the calls made per channel"""
+        kinds = ["create_channel", "send", "upload", "upload_bytes", "thread", "pin", "edit", "429"]
+        rows = [["channel"] + kinds]
+        totals = collections.Counter()
+        for name, counts in self.counts.items():
+            rows.append([name] + [str(counts[k]) for k in kinds])
+            totals.update(counts)
+        rows.append(["total"] + [str(totals[k]) for k in kinds])
+        widths = [max(len(r[i]) for r in rows) for i in range(len(kinds) + 1)]
+        return "\n".join(
+            "  ".join(x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(r, widths)))
+            for r in rows
+        )
+
+
+class DryRunChannel:
+    """A text channel of a DryRunGuild"""
+
+    def __init__(self, guild, name, topic=None):
+        self.guild = guild
+        self.name = name
+        self.topic = topic
+        guild._new_id(self)
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, *, embed=None, file=None):
+        details = content
+        if file is not None:
+            size = len(file.fp.read())
+            self.guild.counts[self.name]["upload"] += 1
+            self.guild.counts[self.name]["upload_bytes"] += size
+            details = (content, file.filename, size)
+        await self.guild._call("send", "send", self, details)
+        return DryRunMessage(self)
+
+    async def edit(self, *, topic):
+        await self.guild._call("edit", "edit", self, topic)
+        self.topic = topic
+
+    def get_partial_message(self, message_id):
+        return DryRunMessage(self, message_id)
+
+
+class DryRunThread(DryRunChannel):
+    """A thread of a DryRunGuild, its calls are counted against its parent channel"""
+
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.thread_name = name
+        super().__init__(parent.guild, parent.name)
+
+
+class DryRunMessage:
+    """A message sent to a DryRunChannel"""
+
+    def __init__(self, channel, message_id=None):
+        self.channel = channel
+        if message_id is None:
+            channel.guild._new_id(self)
+        else:
+            self.id = message_id
+
+    async def fetch(self):
+        return self
+
+    async def pin(self):
+        await self.channel.guild._call("pin", "pin", self.channel, self.id)
+
+    async def create_thread(self, *, name):
+        await self.channel.guild._call("thread", "thread", self.channel, name)
+        return DryRunThread(self.channel, name)
+
+
+class ImportCoordinator:
+    """Shares an import between one or more bots (MyClient instances)
+
+    The channels are split between the bots by their estimated volume (the
+    size of their day files) and each bot imports its share with its own
+    connection and rate limits. Channels are still created in Slack's order:
+    each one once the one before it has been (or was found to have nothing
+    to import), whichever bot it belongs to. The progress of every bot is
+    collected here and the totals are shown once they're all done.
+    """
+
+    def __init__(self, export, bots=1):
+        self._channels = slack_channels(export)
+        self._created = {c: asyncio.Event() for c in self._channels}
+        self._previous = dict(zip(list(self._channels)[1:], self._channels))
+        self._running = bots
+        self._start_time = None
+        self._counts = collections.Counter()
+
+        sizes = {c: sum(export.size(x) for x in export.channel_files(c)) for c in self._channels}
+        self._shards = [set() for _ in range(bots)]
+        loads = [0] * bots
+        for c in sorted(sizes, key=sizes.get, reverse=True):
+            i = loads.index(min(loads))
+            self._shards[i].add(c)
+            loads[i] += sizes[c]
+
+    def channels(self, shard):
+        """The channels (with their info from slack_channels) imported by a bot, in order"""
+        if self._start_time is None:
+            self._start_time = datetime.now()
+        return [(c, info) for c, info in self._channels.items() if c in self._shards[shard]]
+
+    async def wait_turn(self, channel_name):
+        """Wait until a channel can be created"""
+        previous = self._previous.get(channel_name)
+        if previous is not None:
+            await self._created[previous].wait()
+
+    def created(self, channel_name):
+        """Mark a channel as created (or as not needing to be), letting the next one be created"""
+        self._created[channel_name].set()
+
+    def channel_done(self, channel_name, messages):
+        """Record a channel as imported (`messages` is None if there was nothing to import)"""
+        if messages is not None:
+            self._counts["channels"] += 1
+            self._counts["messages"] += messages
+        self._counts["done"] += 1
+        print("Done with channel {}! ({}/{} channels)".format(channel_name, self._counts["done"], len(self._channels)))
+
+    def finish(self, shard, packed_sends=0):
+        """Record a bot as done (or as having given up on its channels)"""
+        for c in self._shards[shard]:
+            self.created(c)
+        self._counts["packed_sends"] += packed_sends
+        self._running -= 1
+        if self._running:
+            return
+        print("Imported {} messages into {} channel(s) in {}".format(
+            self._counts["messages"], self._counts["channels"], datetime.now() - (self._start_time or datetime.now())
+        ))
+        if self._counts["packed_sends"]:
+            print("Packing messages saved {} send calls".format(self._counts["packed_sends"]))
+
+
+class BackgroundCalls:
+    """Calls to Discord on slow routes (pins, topic edits) made in the background
+
+    Calls added with `add` are made one at a time, in order, by a task that
+    runs alongside the import, so sending messages never waits on their
+    rate limits. A call that fails is reported and the ones after it carry
+    on. `drain` waits for every call added so far to be made.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def add(self, description, func, *args, **kwargs):
+        self._queue.put_nowait((description, functools.partial(func, *args, **kwargs)))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def drain(self):
+        await self._queue.join()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            description, call = await self._queue.get()
+            try:
+                await call()
+            except Exception as e:
+                print("Failed to {}: {}".format(description, e))
+            finally:
+                self._queue.task_done()
+
+
+class RateLimitStats(logging.Handler):
+    """Adds the rate limit waits that discord.py logs to an ImportStats
+
+    discord.py waits out rate limits inside its requests, only logging them:
+    a 429 response is retried after the time it gives and once a bucket is
+    used up, the next request to it waits for it to reset.
+    """
+
+    def __init__(self, stats):
+        super().__init__(logging.DEBUG)
+        self._stats = stats
+
+    def emit(self, record):
+        if record.msg.startswith("We are being rate limited"):
+            self._stats.count("429")
+            self._stats.observe("ratelimit", record.args[0])
+        elif record.msg.startswith("A rate limit bucket has been exhausted"):
+            self._stats.observe("ratelimit", record.args[1])
+
+
+@contextlib.contextmanager
+def log_rate_limits(stats):
+    """Add the rate limit waits of every bot to an ImportStats while in the block"""
+    logger = logging.getLogger("discord.http")
+    handler = RateLimitStats(stats)
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+
+class MyClient(discord.Client):
+
+    def __init__(self, *args, export, journal, guild_name, all_private, skip_existing_channels, start, end,
+                 concurrency=IMPORT_CONCURRENCY, thread_concurrency=THREAD_CONCURRENCY, pack=False, parse_workers=PARSE_WORKERS,
+                 download_workers=DOWNLOAD_WORKERS, download_memory=DOWNLOAD_MEMORY_BUDGET, attachment_cache=None, transport=None,
+                 coordinator=None, shard=0, delta=False, stats=None, profile_dir=None, **kwargs):
+        self._export = export
+        self._coordinator = coordinator
+        self._shard = shard
+        self._delta = delta
+        self._stats = stats
+        self._profile_dir = profile_dir
+        self._transport = transport or BotTransport()
+        self._journal = journal
+        self._download_workers = download_workers
+        self._download_memory = download_memory
+        self._attachment_cache = attachment_cache
+        self._fetcher = None
+        self._guild_name = guild_name
+        self._concurrency = concurrency
+        self._thread_concurrency = thread_concurrency
+        self._thread_slots = None
+        self._pack = pack
+        self._parse_workers = parse_workers
+        self._packed_sends = 0
+        self._prev_date = {}
+        self._background = {}
+        self._all_private = all_private
+        self._skip_existing_channels = skip_existing_channels
+        self._start, self._end = [datetime.strptime(x, DATE_FORMAT).date() if x else None for x in (start, end)]
+
+        self._started = False # TODO: async equiv of a threading.event
+        super().__init__(*args, **kwargs)
+
+    async def dry_run(self, guild):
+        """Import into a DryRunGuild (or some other stand-in) without connecting to Discord"""
+        try:
+            await self._run_import(guild)
+        finally:
+            await self.close()
+
+    async def on_ready(self):
+        if self._started:
+            return
+
+        print("Done!")
+        try:
+            g = discord.utils.get(self.guilds, name=self._guild_name)
+            if g is None:
+                print("Guild {} not accessible to bot".format(self._guild_name))
+                print("Available guilds:\n{}\n".format(self.guilds))
+                self._coordinator.finish(self._shard)
+                return
+
+            await self._run_import(g)
+        finally:
+            print("Bot logging out")
+            await self.close()
+
+
+    async def _send_slack_msg(self, name, channel: TextChannel, msg, thread=None):
+        is_reply = bool(thread)
+
+        if not is_reply and DATE_SEPARATOR:
+            msg_date = msg.date
+            if name not in self._prev_date:
+                # Carry on from the day of the last message an earlier import sent
+                mark = self._journal.mark(name)
+                if mark is not None:
+                    self._prev_date[name] = datetime.fromtimestamp(float(mark[0])).strftime(DATE_FORMAT)
+            # A message that was already sent (or its separator) isn't given another one
+            sent = any(self._journal.posted(name, msg.ts, part) is not None for part in (-1, 0))
+            if self._prev_date.get(name) != msg_date and not sent:
+                with self._time("send"):
+                    sep = await self._transport.send(channel, {"content": DATE_SEPARATOR.format(msg_date)})
+                self._journal.record_post(name, msg.ts, -1, sep.id)
+            self._prev_date[name] = msg_date
+
+        self._packed_sends += message_count(msg) - 1
+        message_obj = None
+        pin = msg.events.get("pin", False)
+        for part, data in enumerate(msg.plan):
+            posted = self._journal.posted(name, msg.ts, part)
+            if posted is not None:
+                # Already sent before the import was interrupted (but maybe not pinned yet)
+                if self._stats is not None:
+                    self._stats.skipped(name)
+                message_obj = (thread or channel).get_partial_message(posted)
+                if pin and not self._journal.pinned(name, msg.ts):
+                    self._background[name].add("pin message", self._pin, name, msg.ts, message_obj)
+                pin = False
+                continue
+
+            attempts = file_upload_attempts(data, self._fetcher)
+            try:
+                async for tries, attempt in aenumerate(attempts):
+                    if tries and self._stats is not None:
+                        self._stats.count("retry")
+                    with contextlib.suppress(Exception):
+                        # Packed messages have everyone's names in the text,
+                        # so they're posted under the webhook's own name
+                        username = None if msg.packed else msg.username
+                        with self._time("send"):
+                            message_obj = await self._transport.send(channel, attempt, username, thread)
+                        self._journal.record_post(name, msg.ts, part, message_obj.id)
+                        # Merged messages are posted with the first one (so a
+                        # delta import can find them to add replies)
+                        for m in msg.packed[1:]:
+                            self._journal.record_post(name, m.ts, part, message_obj.id)
+                        if pin:
+                            pin = False
+                            self._background[name].add("pin message", self._pin, name, msg.ts, message_obj)
+                        break
+                else:
+                    if self._stats is not None:
+                        self._stats.count("send_failed")
+                    print("Failed to post message: '{}'\n".format(data["content"]))
+            finally:
+                # closes the file that was sent
+                await attempts.aclose()
+            if self._stats is not None:
+                self._stats.sent(name)
+        self._fetcher.release(msg.files)
+        if is_reply:
+            message_obj = None
+
+        return message_obj
+
+    def _time(self, stage):
+        return self._stats.time(stage) if self._stats is not None else contextlib.nullcontext()
+
+    async def _pin(self, name, ts, message_obj):
+        # Requires the "manage messages" optional permission
+        with contextlib.suppress(Forbidden):
+            await message_obj.pin()
+        self._journal.record_pin(name, ts)
+
+    async def _get_thread(self, name, channel: TextChannel, msg, message_obj):
+        """Create the thread for the replies to a message (or find it if resuming)"""
+        thread_id = self._journal.thread_id(name, msg.ts)
+        if thread_id is not None:
+            return channel.guild.get_thread(thread_id) or await self.fetch_channel(thread_id)
+
+        if isinstance(message_obj, discord.PartialMessage):
+            message_obj = await message_obj.fetch()
+        tname = " ".join(msg.text.split()[:THREAD_NAME_MAX_NWORDS])[:THREAD_NAME_MAX_NSYMBOLS]
+        tname = tname if len(tname) else "Thread"  # if thread created for image-message that absent text discord.py cannot create thread
+        with self._time("thread"):
+            thrd = await message_obj.create_thread(name=tname)
+        self._journal.record_thread(name, msg.ts, thrd.id)
+        return thrd
+
+    async def _send_replies(self, name, channel, thread, parent_ts, replies):
+        """Send the replies to a thread in order, returning the number of messages sent"""
+        count = 0
+        for rmsg in replies:
+            await self._send_slack_msg(name, channel, rmsg, thread=thread)
+            self._journal.record_mark(name, last_ts(rmsg), thread=parent_ts)
+            count += message_count(rmsg)
+        return count
+
+    async def _run_import(self, g):
+        self._started = True
+        if self._coordinator is None:
+            self._coordinator = ImportCoordinator(self._export)
+        self._fetcher = AttachmentFetcher(
+            self._download_workers, self._download_memory, size_limit=g.filesize_limit, cache=self._attachment_cache,
+            stats=self._stats,
+        )
+        self._thread_slots = asyncio.Semaphore(max(1, self._thread_concurrency))
+        try:
+            await self._import_channels(g)
+        finally:
+            await self._fetcher.close()
+            await self._transport.close()
+
+    async def _import_channels(self, g):
+        index = WorkspaceIndex.from_export(self._export, {x.name: str(x) for x in self.emojis})
+
+        print("Importing messages...")
+
+        existing_channels = {x.name: x for x in g.text_channels}
+
+        # This bot's channels are imported by a pool of workers that take them
+        # in order. Each one is created only once the ones before it have been
+        # (or were found to have nothing to import) so they keep Slack's order
+        # in the channel list (see ImportCoordinator). Discord's rate limits
+        # are per channel/thread (plus a global one per bot) and are enforced
+        # by discord.py for every worker.
+        channels = []
+        for c, info in self._coordinator.channels(self._shard):
+            if self._skip_channel(c, existing_channels):
+                self._coordinator.created(c)
+            else:
+                channels.append((c, info))
+        todo = iter(channels)
+
+        # A delta import only parses what's new since the last import of each channel
+        since = {}
+        if self._delta:
+            for c, _ in channels:
+                mark = self._journal.mark(c)
+                if mark is not None:
+                    since[c] = mark
+
+        if self._stats is not None:
+            for c, _ in channels:
+                self._stats.add_channel(c, sum(self._export.size(x) for x in self._export.channel_files(c)))
+
+        # Channels are parsed in other processes while the ones before them are sent
+        parser = ChannelParser(
+            self._export, index, [(c, pins) for c, (_, _, pins) in channels],
+            workers=self._parse_workers, ahead=self._concurrency + PARSE_AHEAD, since=since,
+            stats=self._stats, profile_dir=self._profile_dir,
+            start=self._start, end=self._end, pack=self._pack, usernames=self._transport.show_usernames,
+        )
+
+        async def worker():
+            for c, info in todo:
+                try:
+                    imported = await self._import_channel(
+                        g, c, *info,
+                        index=index,
+                        parser=parser,
+                        existing_channels=existing_channels,
+                    )
+                finally:
+                    self._coordinator.created(c)
+                self._coordinator.channel_done(c, imported)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, self._concurrency))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            await parser.close()
+            self._coordinator.finish(self._shard, self._packed_sends)
+
+    def _skip_channel(self, c, existing_channels):
+        if self._skip_existing_channels and c in existing_channels and self._journal.channel_id(c) is None:
+            print("Pass existing channel '{}'".format(c))
+            return True
+        return False
+
+    async def _import_channel(self, g, c, init_topic, is_private, pins, *, index, parser, existing_channels):
+        """Import a single channel, returning the number of messages sent (None if there were none)"""
+        init_topic = emoji_replace(init_topic, index.emoji_map)
+        ch = None
+        c_msg = 0
+
+        print("Processing channel {}...".format(c))
+        messages = await parser.messages(c)
+
+        # Tasks posting replies to threads (see _send_replies)
+        threads = []
+        # Pins and the topic are set in the background (see BackgroundCalls)
+        background = self._background[c] = BackgroundCalls()
+        topic = None
+        try:
+            async for msg in prefetch_messages(messages, self._fetcher):
+
+                # Now that we have a message to send, get/create the channel to send it to
+                if ch is None:
+                    await self._coordinator.wait_turn(c)
+                    ch = g.get_channel(self._journal.channel_id(c) or 0)
+                    if ch is None:
+                        if c not in existing_channels:
+                            if self._all_private or is_private:
+                                print("Creating private channel {}".format(c))
+                                overwrites = {
+                                    g.default_role: discord.PermissionOverwrite(read_messages=False),
+                                    g.me: discord.PermissionOverwrite(read_messages=True),
+                                }
+                                ch = await g.create_text_channel(c, topic=init_topic, overwrites=overwrites)
+                            else:
+                                print("Creating public channel {}".format(c))
+                                ch = await g.create_text_channel(c, topic=init_topic)
+                        else:
+                            ch = existing_channels[c]
+                    self._journal.record_channel(c, ch.id)
+                    self._coordinator.created(c)
+                    print("Sending messages to {}...".format(c))
+
+                topic = msg.events.get("topic", topic)
+
+                # Send the message, then hand its replies to a task that posts
+                # them to the thread while the channel carries on
+                if "imported" in msg.events:
+                    # New replies to a message sent by an earlier import
+                    message_obj = self._journal.last_post(c, msg.ts)
+                    if message_obj is None:
+                        print("Skipping replies to message {} in {} that wasn't imported".format(msg.ts, c))
+                        continue
+                    message_obj = ch.get_partial_message(message_obj)
+                else:
+                    message_obj = await self._send_slack_msg(c, ch, msg)
+                    self._journal.record_mark(c, last_ts(msg))
+                    c_msg += message_count(msg)
+                if len(msg.replies) and message_obj is not None:
+                    thrd = await self._get_thread(c, ch, msg, message_obj)
+                    # Only so many threads (across all channels) are sent to at a time
+                    await self._thread_slots.acquire()
+                    task = asyncio.ensure_future(self._send_replies(c, ch, thrd, msg.ts, msg.replies))
+                    task.add_done_callback(lambda _: self._thread_slots.release())
+                    threads.append(task)
+                    for t in [t for t in threads if t.done()]:
+                        threads.remove(t)
+                        c_msg += t.result()
+
+            # The ratelimit for topic edits is pretty extreme (2 edits per 10
+            # minutes) so only the topic the channel ends up with is set
+            if topic is not None and topic != ch.topic:
+                background.add("set the topic of {}".format(c), ch.edit, topic=topic)
+
+            # The channel is only done once all of its threads and background calls are
+            c_msg += sum(await asyncio.gather(*threads))
+            await background.drain()
+        finally:
+            for t in threads:
+                t.cancel()
+            background.close()
+            del self._background[c]
+        parser.done(c)
+        return c_msg if ch is not None else None